@@ -0,0 +1,67 @@
+""" Прогрев бота перед получением апдейтов.
+    Без него первые пользователи после запуска ждут открытия подключений к бд,
+    загрузки справочников и подготовки запросов
+"""
+
+import logging
+import os
+
+from contextlib import AsyncExitStack
+from time import monotonic
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from database.leaderboard import get_leaderboard
+from database.methods import engine, replica_sessions, get_food_catalog
+from database.models import User, UserTamagochi, TypeTamagochi
+from utilites.logger import get_logger
+
+logger = get_logger('bootstrap', file_level=logging.DEBUG, console_level=logging.INFO)
+
+# Сколько подключений открыть заранее в каждом пуле (по умолчанию размер пула SQLAlchemy)
+WARM_CONNECTIONS = int(os.getenv('db_warm_connections', 5))
+
+# Запросы, которые выполняются почти в каждом апдейте. Выполнение на каждом подключении
+# заполняет кэш скомпилированных запросов SQLAlchemy и кэш prepared statements asyncpg
+HOT_STATEMENTS = (
+    select(User).where(User.user_telegram_id == 0),
+    select(UserTamagochi).join(User).where(User.user_telegram_id == 0),
+    select(TypeTamagochi.name),
+)
+
+
+async def _warm_pool(pool_engine: AsyncEngine, connections: int) -> None:
+    """ Открывает connections подключений одновременно (не больше размера пула) и готовит на них горячие запросы.
+        Подключения возвращаются в пул открытыми
+    """
+
+    connections = min(connections, pool_engine.pool.size())
+    async with AsyncExitStack() as stack:
+        opened = [await stack.enter_async_context(pool_engine.connect()) for _ in range(connections)]
+        for conn in opened:
+            for statement in HOT_STATEMENTS:
+                await conn.execute(statement)
+            await conn.rollback()
+
+
+async def warm_up() -> float:
+    """ Прогревает пулы подключений и справочники. Ошибки прогрева не мешают запуску бота.
+        Возвращает длительность прогрева в секундах
+    """
+
+    started = monotonic()
+    engines = [engine, *(session_maker.kw['bind'] for session_maker in replica_sessions)]
+    for pool_engine in engines:
+        try:
+            await _warm_pool(pool_engine, WARM_CONNECTIONS)
+        except Exception as e:
+            logger.error(f'Ошибка прогрева подключений {pool_engine.url.host}: {e}')
+    try:
+        await get_food_catalog()
+        await get_leaderboard('happy')
+    except Exception as e:
+        logger.error(f'Ошибка загрузки справочников при прогреве: {e}')
+    duration = monotonic() - started
+    logger.info(f'Прогрев завершен за {duration:.2f} с, подключений в пуле: {WARM_CONNECTIONS * len(engines)}')
+    return duration
@@ -3,32 +3,70 @@
 import asyncio
 import logging
 import os
+import signal
 
+from functools import wraps
 from random import sample, choice
+from time import monotonic
+from typing import AsyncIterator
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.request import BaseRequest
 from telegram.ext import (ApplicationBuilder,
                           ContextTypes,
                           filters,
                           CommandHandler,
                           MessageHandler,
-                          CallbackQueryHandler)
+                          CallbackQueryHandler,
+                          TypeHandler)
 
-from database.methods import (get_user,
+from database.methods import (engine,
+                              replica_sessions,
+                              get_user,
                               create_user,
                               create_user_tamagochi,
                               get_user_tamagochi,
                               get_types_pet,
                               rename,
-                              get_all_foods,
+                              get_food_catalog,
                               update_user_last_request,
                               check_is_sleep,
                               get_hiding_places,
                               check_is_sick,
-                              check_user_pet_energy)
+                              check_user_pet_energy,
+                              get_decay_runs)
 
+from database.admission import admission, DatabaseBusy
 from database.db_init.create_and_populate_db import initialize_database
-from database.pet_condition_update import feed_pet, grooming_pet, therapy, sleep, play_hide_and_seek
+from database.event_log import event_log
+from database.stat_history import stat_history, get_stat_history
+from database.leaderboard import get_leaderboard, BOARDS
+from database.pet_condition_update import (feed_pet,
+                                           grooming_pet,
+                                           therapy,
+                                           sleep,
+                                           play_hide_and_seek,
+                                           wake_up_pets,
+                                           rehydrate_pet)
+
+from bot.rendering import (render_stats,
+                           render_action_result,
+                           render_history,
+                           render_leaderboard,
+                           food_keyboard,
+                           pet_type_keyboard)
+from bot.send_queue import SendQueue, BULK, GLOBAL_RATE
+from bot.middleware import FloodGuard, CallbackDeduplicator
+from bot.scheduler import create_scheduler
+from bot.pet_events import PetEventListener
+from bot.state import conversation_state
+from bot.cards import pet_cards, card_key
+from bot.bootstrap import warm_up
+from bot.health import readiness
+from bot.traffic import TrafficRecorder, RECORD_TRAFFIC, RECORDER_GROUP
+
+from utilites.profiler import HandlerProfiler
 
 from utilites.utilites import validation_name
 from utilites.logger import get_logger
@@ -37,6 +75,21 @@ logger = get_logger('bot', file_level=logging.DEBUG, console_level=logging.INFO)
 
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv('bot_token')
+# celery - уменьшение характеристик запускает celery beat, inprocess - планировщик внутри бота
+SCHEDULER_MODE = os.getenv('scheduler', 'celery')
+# Уведомления хозяев об изменениях питомцев через LISTEN/NOTIFY. Включать на одном экземпляре бота
+PET_EVENTS_ENABLED = os.getenv('pet_events', 'off') == 'on'
+ADMIN_IDS = [int(admin_id) for admin_id in os.getenv('admin_ids', '').split(',') if admin_id.strip()]
+
+# Сколько при остановке ждать обработки уже полученных апдейтов и записи буферов
+SHUTDOWN_TIMEOUT = float(os.getenv('shutdown_timeout', 20))
+
+# Сколько ждать выбора места в прятках. Остальные диалоги хранятся StateStore.default_ttl
+PLAY_TTL = 600
+
+# Группы промежуточных обработчиков, выполняются раньше основных (группа 0)
+FLOOD_GUARD_GROUP = -2
+CALLBACK_DEDUP_GROUP = -1
 
 
 def check_user_registered_or_create_user(func):
@@ -56,10 +109,23 @@ def check_user_registered_or_create_user(func):
     return wrapper
 
 
+async def _touch_owner(update: Update, pet) -> None:
+    """ Отмечает активность хозяина. Замороженный питомец размораживается в той же транзакции:
+        уменьшение за время заморозки применяется до того, как команда прочитает характеристики
+    """
+
+    if pet.dormant:
+        await rehydrate_pet(update.effective_user)
+    else:
+        await update_user_last_request(update.effective_user)
+
+
 def check_pet_exists(func):
     """ Декоратор
         Проверяет есть ли у пользователя питомец,
-        если его нет, то отправляет сообщение с предложением создать
+        если его нет, то отправляет сообщение с предложением создать.
+        Обновляет время последнего запроса пользователя, от него зависит заморозка питомца,
+        и размораживает питомца до выполнения команды
     """
 
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -69,6 +135,7 @@ def check_pet_exists(func):
             logger.info(f'Запрос к питомцу от пользователя {update.effective_user.id}, который его не имеет')
             return
         else:
+            await _touch_owner(update, pet)
             return await func(update, context)
 
     return wrapper
@@ -111,29 +178,89 @@ def check_pet_sick(func):
 
 
 class PetBot:
-    """ Telegram-бот """
+    """ Telegram-бот
+        shard, shards - номер процесса и количество процессов при запуске с шардированием (bot/sharding.py)
+        request - транспорт Telegram API, например заглушка при воспроизведении трафика (bot/traffic.py)
+        rate_limits=False - без ограничения частоты апдейтов (FloodGuard) и отправки (SendQueue),
+        чтобы при воспроизведении трафика измерялась скорость самого бота, а не ограничителей
+    """
 
-    def __init__(self):
-        self.application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    def __init__(self,
+                 shard: int = 0,
+                 shards: int = 1,
+                 request: BaseRequest | None = None,
+                 rate_limits: bool = True):
+        self.send_queue = SendQueue(global_rate=GLOBAL_RATE / shards)
+        self.flood_guard = FloodGuard()
+        self.callback_dedup = CallbackDeduplicator()
+        self.profiler = HandlerProfiler()
+        self.scheduler = create_scheduler(self.notify_awakened_pets) if SCHEDULER_MODE == 'inprocess' else None
+        # Уведомления о событиях питомцев отправляет только первый процесс
+        self.pet_events = self._create_pet_event_listener() if PET_EVENTS_ENABLED and shard == 0 else None
+        # Порт проверок состояния открывает только первый процесс
+        self.readiness = readiness if shard == 0 else None
+        self.recorder = TrafficRecorder(RECORD_TRAFFIC, shard) if RECORD_TRAFFIC else None
+        self.rate_limits = rate_limits
+        # Задачи, в которых сейчас выполняются обработчики апдейтов
+        self._in_flight: set[asyncio.Task] = set()
+        builder = ApplicationBuilder()
+        if rate_limits:
+            builder = builder.rate_limiter(self.send_queue)
+        if request is not None:
+            # Заглушке токен не нужен, поэтому воспроизведение работает и без bot_token
+            builder = builder.token(TELEGRAM_BOT_TOKEN or '0:replay').request(request)
+        else:
+            builder = builder.token(TELEGRAM_BOT_TOKEN)
+        self.application = builder.build()
         self._register_handlers()
 
     def _register_handlers(self):
+        # Промежуточные обработчики выполняются раньше всех хендлеров и до обращений к бд
+        if self.recorder is not None:
+            self.application.add_handler(TypeHandler(Update, self.recorder), group=RECORDER_GROUP)
+        if self.rate_limits:
+            self.application.add_handler(TypeHandler(Update, self.flood_guard), group=FLOOD_GUARD_GROUP)
+        self.application.add_handler(CallbackQueryHandler(self.callback_dedup), group=CALLBACK_DEDUP_GROUP)
         self.application.add_handler(CommandHandler('check', self.check_pet_stats))
         self.application.add_handler(CommandHandler('create', self.create_pet))
         self.application.add_handler(CommandHandler('feed', self.feed))
         self.application.add_handler(CommandHandler('grooming', self.grooming_pet))
+        self.application.add_handler(CommandHandler('history', self.pet_history))
         self.application.add_handler(CommandHandler('play', self.play_with_pet))
         self.application.add_handler(CommandHandler('rename', self.rename_pet))
         self.application.add_handler(CommandHandler('sleep', self.sleep_pet))
         self.application.add_handler(CommandHandler('start', self.start))
         self.application.add_handler(CommandHandler('therapy', self.therapy))
+        self.application.add_handler(CommandHandler('top', self.top_pets))
         self.application.add_handler(CommandHandler('XLir3HJkIDRsFyM', self.create_database))
-        self.application.add_handler(CallbackQueryHandler(self.choice_food, pattern=r'food_.*$'))
+        self.application.add_handler(CallbackQueryHandler(self.choice_food, pattern=r'^food_\d+$'))
         self.application.add_handler(CallbackQueryHandler(self.choice_pet, pattern=r'pet_.*$'))
         self.application.add_handler(CallbackQueryHandler(self.choice_place, pattern=r'place_.*$'))
         self.application.add_handler(
             MessageHandler(filters.TEXT & ~filters.COMMAND, self.process_user_message))
 
+        # Основные хендлеры оборачиваются выборочным профилировщиком (выключен при sample_rate = 0)
+        for handler in self.application.handlers[0]:
+            handler.callback = self._track(self.profiler.wrap(handler.callback))
+        self.application.add_handler(CommandHandler('profile', self.set_profiling, filters=filters.User(ADMIN_IDS)))
+        self.application.add_handler(CommandHandler('decay', self.decay_history, filters=filters.User(ADMIN_IDS)))
+        self.application.add_handler(CommandHandler('stats', self.runtime_stats, filters=filters.User(ADMIN_IDS)))
+        self.application.add_error_handler(self.on_error)
+        self.application.add_error_handler(self.callback_dedup.on_error)
+
+    @staticmethod
+    async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """ Обработчик ошибок хендлеров.
+            Если бд перегружена, пользователь сразу получает короткий ответ вместо ожидания
+        """
+
+        if isinstance(context.error, DatabaseBusy):
+            logger.warning(f'Бд перегружена, апдейт не обработан: {context.error}')
+            if isinstance(update, Update) and update.effective_message is not None:
+                await update.effective_message.reply_text('Сейчас я очень занят, попробуй еще раз через минуту 🙏')
+            return
+        logger.error(f'Ошибка при обработке апдейта: {context.error}', exc_info=context.error)
+
     @staticmethod
     @check_user_registered_or_create_user
     async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -143,8 +270,8 @@ class PetBot:
         """
 
         user_pet = await get_user_tamagochi(update.effective_user)
-        await update_user_last_request(update.effective_user)
         if user_pet:
+            await _touch_owner(update, user_pet)
             answer = (f'Привет! Я соскучился\n'
                       f'Вот как ты можешь со мной взаимодействовать:\n'
                       f'1. Кормить меня - /feed 🍽️\n'
@@ -159,6 +286,7 @@ class PetBot:
                                          photo=user_pet.type_pet.image_url,
                                          caption=answer)
         else:
+            await update_user_last_request(update.effective_user)
             await update.message.reply_text('Привет! Используйте команду /create для создания питомца')
         logger.info(f'Пользователь {update.effective_user.id} /start')
 
@@ -190,8 +318,8 @@ class PetBot:
             places = await get_hiding_places()
             random_places = sample(places, 3)
             true_place = choice(random_places)
-            context.user_data['true_place'] = true_place['place']
-            context.user_data['place_reaction'] = true_place['reaction']
+            conversation_state.set(update.effective_user.id, 'true_place', true_place['place'], ttl=PLAY_TTL)
+            conversation_state.set(update.effective_user.id, 'place_reaction', true_place['reaction'], ttl=PLAY_TTL)
 
             keyboard = []
             for place in random_places:
@@ -203,18 +331,27 @@ class PetBot:
     @staticmethod
     async def choice_place(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """ Проверяет выбор пользователя при игре в прятки.
-            Удаляет варианты выбора из диалога.
+            Удаляет варианты выбора из диалога после обновления питомца:
+            если бд не ответила, игра и кнопки остаются, и выбор можно повторить.
             Если пользователь угадал правильное место, то обновляет статы питомца.
             Если не угадал, то предлагает начать заново
         """
 
         query = update.callback_query
-        await query.answer()
+        true_place = conversation_state.get(update.effective_user.id, 'true_place')
+        place_reaction = conversation_state.get(update.effective_user.id, 'place_reaction')
+        if true_place is None:
+            await query.edit_message_reply_markup(reply_markup=None)
+            await context.bot.send_message(update.effective_user.id, 'Эта игра уже закончилась, начнем новую? /play')
+            return
+
+        user_choice_place = query.data.removeprefix('place_')
+        user_pet = await play_hide_and_seek(update.effective_user) if user_choice_place == true_place else None
+        conversation_state.pop(update.effective_user.id, 'true_place')
+        conversation_state.pop(update.effective_user.id, 'place_reaction')
         await query.edit_message_reply_markup(reply_markup=None)
-        user_choice_place = query.data.split('_')[1]
-        if user_choice_place == context.user_data['true_place']:
-            user_pet = await play_hide_and_seek(update.effective_user)
-            place_reaction = context.user_data['place_reaction']
+        event_log.emit(update.effective_user.id, 'play', found=user_choice_place == true_place)
+        if user_choice_place == true_place:
             answer = (f'{place_reaction}\n'
                       f'{user_pet["reaction"]}\n'
                       f'/play'
@@ -224,8 +361,6 @@ class PetBot:
             answer = (f'Ты не угадал! Я прятался в другом месте, попробуем снова?\n'
                       f'/play')
             await context.bot.send_message(update.effective_user.id, answer)
-        del context.user_data['true_place']
-        del context.user_data['place_reaction']
 
     @staticmethod
     @check_pet_exists
@@ -236,18 +371,8 @@ class PetBot:
         """
 
         user_pet = await grooming_pet(update.effective_user)
-        answer = (f'{user_pet["reaction"]}\n'
-                  f'Я себя чувствую вот так:\n'
-                  f'Здоровье: {user_pet["health"]}\n'
-                  f'Настроение: {user_pet["happiness"]}\n'
-                  f'Чистота: {user_pet["grooming"]}\n'
-                  f'Энергия: {user_pet["energy"]}\n'
-                  f'Сытость: {user_pet["hunger"]}\n'
-                  )
-        if user_pet['sick']:
-            answer += 'Я заболел('
-        else:
-            answer += 'Я здоров)'
+        event_log.emit(update.effective_user.id, 'grooming')
+        answer = render_action_result(user_pet)
         await context.bot.send_message(update.effective_user.id, answer)
 
     @staticmethod
@@ -259,18 +384,8 @@ class PetBot:
         """
 
         user_pet = await therapy(update.effective_user)
-        answer = (f'{user_pet["reaction"]}\n'
-                  f'Я себя чувствую вот так:\n'
-                  f'Здоровье: {user_pet["health"]}\n'
-                  f'Настроение: {user_pet["happiness"]}\n'
-                  f'Чистота: {user_pet["grooming"]}\n'
-                  f'Энергия: {user_pet["energy"]}\n'
-                  f'Сытость: {user_pet["hunger"]}\n'
-                  )
-        if user_pet['sick']:
-            answer += 'Я заболел('
-        else:
-            answer += 'Я здоров)'
+        event_log.emit(update.effective_user.id, 'therapy')
+        answer = render_action_result(user_pet)
         await context.bot.send_message(update.effective_user.id, answer)
 
     @staticmethod
@@ -283,6 +398,7 @@ class PetBot:
         """
 
         pet = await sleep(update.effective_user)
+        event_log.emit(update.effective_user.id, 'sleep')
         await context.bot.send_message(update.effective_user.id, pet['reaction'])
         logger.info(f'Пользователь {update.effective_user.id} отправил питомца спать')
 
@@ -300,11 +416,7 @@ class PetBot:
             await update.message.reply_text(f'Хей, у тебя уже есть я, {user_pet.name}')
         else:
             type_pets = await get_types_pet()
-            keyboard = []
-            for type_pet in type_pets:
-                keyboard.append([InlineKeyboardButton(type_pet, callback_data=f'pet_{type_pet}')])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = pet_type_keyboard.get(type_pets)
             await update.message.reply_text('Выберите питомца:', reply_markup=reply_markup)
             logger.info(f'Пользователь {update.effective_user.id} инициировал создание питомца')
 
@@ -320,17 +432,16 @@ class PetBot:
             await update.message.reply_text(f'Хей, у тебя уже есть я, {pet.name}')
         else:
             query = update.callback_query
-            await query.answer()
             await query.edit_message_reply_markup(reply_markup=None)
 
             pet_type = query.data.split('_')[1]
-            context.user_data['pet_type'] = pet_type
+            conversation_state.set(update.effective_user.id, 'pet_type', pet_type)
 
             await context.bot.send_message(update.effective_user.id, 'Выберите имя для вашего питомца:')
 
             logger.info(f'Пользователь {update.effective_user.id} создал питомца {pet_type}')
 
-        context.user_data['waiting_for_name'] = True
+        conversation_state.set(update.effective_user.id, 'waiting_for_name', True)
 
     @staticmethod
     @check_pet_exists
@@ -339,9 +450,8 @@ class PetBot:
             Запускает обработчик сообщений для выбора нового имени питомца
         """
 
-        await update_user_last_request(update.effective_user)
         await update.message.reply_text('Как ты меня хочешь назвать?')
-        context.user_data['rename'] = True
+        conversation_state.set(update.effective_user.id, 'rename', True)
 
     @staticmethod
     @check_pet_exists
@@ -351,39 +461,26 @@ class PetBot:
             Предлагает пользователю выбрать какой едой покормить питомца
         """
 
-        await update_user_last_request(update.effective_user)
-        foods = await get_all_foods()
-        keyboard = []
-        for food in foods:
-            keyboard.append([InlineKeyboardButton(food, callback_data=f'food_{food}')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        foods = await get_food_catalog()
+        reply_markup = food_keyboard.get((food_id, food.name) for food_id, food in foods.items())
         await update.message.reply_text('Чем ты меня покормишь?', reply_markup=reply_markup)
 
     @staticmethod
     async def choice_food(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """ Сохранение выбора еды.
-            Удаляет варианты ответа из диалога.
-            Запускает обновление характеристик питомца
+            Запускает обновление характеристик питомца.
+            Удаляет варианты ответа из диалога после обновления: если бд не ответила, кнопки остаются
         """
 
         query = update.callback_query
-        await query.answer()
+        food_id = int(query.data.removeprefix('food_'))
+        user_pet = await feed_pet(update.effective_user, food_id)
         await query.edit_message_reply_markup(reply_markup=None)
-
-        my_food = query.data.split('_')[1]
-        user_pet = await feed_pet(update.effective_user, my_food)
-        answer = (f'{user_pet["reaction"]}\n'
-                  f'Я себя чувствую вот так:\n'
-                  f'Здоровье: {user_pet["health"]}\n'
-                  f'Настроение: {user_pet["happiness"]}\n'
-                  f'Чистота: {user_pet["grooming"]}\n'
-                  f'Энергия: {user_pet["energy"]}\n'
-                  f'Сытость: {user_pet["hunger"]}\n'
-                  )
-        if user_pet['sick']:
-            answer += 'Я заболел('
-        else:
-            answer += 'Я здоров)'
+        if user_pet is None:
+            await context.bot.send_message(update.effective_user.id, 'Такой еды у меня нет, попробуй /feed')
+            return
+        event_log.emit(update.effective_user.id, 'feed', food_id=food_id)
+        answer = render_action_result(user_pet)
         await context.bot.send_message(update.effective_user.id, answer)
 
         logger.info(f'Пользователь {update.effective_user.id} покормил питомца')
@@ -395,9 +492,9 @@ class PetBot:
             Если rename = True, то ожидает ввода нового имени.
         """
 
-        if context.user_data.get('waiting_for_name'):
+        if conversation_state.get(update.effective_user.id, 'waiting_for_name'):
             await self.input_name(update, context)
-        if context.user_data.get('rename'):
+        if conversation_state.get(update.effective_user.id, 'rename'):
             await self.input_name_for_rename(update, context)
 
     @staticmethod
@@ -406,13 +503,13 @@ class PetBot:
         """ Обрабатывает вводит имени питомца при создании """
 
         pet_name = update.message.text
-        pet_type = context.user_data.get('pet_type')
-        context.user_data['pet_name'] = pet_name
+        pet_type = conversation_state.get(update.effective_user.id, 'pet_type')
         logger.info(f'Пользователь {update.effective_user.id} выбрал имя питомца {pet_name}')
 
         pet = await create_user_tamagochi(update.effective_user,
                                           pet_name,
                                           pet_type)
+        event_log.emit(update.effective_user.id, 'create', pet_type=pet_type)
         answer = (f'Привет! Я твой новый питомец {pet_type} по имени {pet_name} 🐾\n!'
                   f'Вот как ты можешь со мной взаимодействовать:\n'
                   f'1. Кормить меня - /feed 🍽️\n'
@@ -426,9 +523,8 @@ class PetBot:
                                      photo=pet.type_pet.image_url,
                                      caption=answer)
 
-        del context.user_data['pet_type']
-        del context.user_data['pet_name']
-        del context.user_data['waiting_for_name']
+        conversation_state.pop(update.effective_user.id, 'pet_type')
+        conversation_state.pop(update.effective_user.id, 'waiting_for_name')
 
     @staticmethod
     @validation_name
@@ -437,8 +533,9 @@ class PetBot:
 
         new_name = update.message.text
         await rename(update.effective_user, new_name)
+        event_log.emit(update.effective_user.id, 'rename')
         await update.message.reply_text(f'Теперь меня зовут {new_name}')
-        del context.user_data['rename']
+        conversation_state.pop(update.effective_user.id, 'rename')
         logger.info(f'Пользователь {update.effective_user.id} переименовал питомца')
 
     @staticmethod
@@ -448,42 +545,295 @@ class PetBot:
             Выводит пользователю текущее состояние его питомца
         """
 
-        await update_user_last_request(update.effective_user)
         pet = await get_user_tamagochi(update.effective_user)
-        answer = (f'Я себя чувствую вот так:\n'
-                  f'Здоровье: {pet.health}\n'
-                  f'Настроение: {pet.happiness}\n'
-                  f'Чистота: {pet.grooming}\n'
-                  f'Энергия: {pet.energy}\n'
-                  f'Сытость: {pet.hunger}\n'
-                  )
-        if pet.sick:
-            answer += 'Я заболел('
-        else:
-            answer += 'Я здоров)'
-        await context.bot.send_photo(chat_id=update.effective_user.id,
-                                     photo=pet.type_pet.image_url,
-                                     caption=answer)
+        answer = render_stats(pet)
+        # Карточка с картинкой питомца и полосками характеристик, без Pillow - обычная картинка питомца
+        card = card_key(pet) if pet_cards.enabled else None
+        photo = await pet_cards.photo(card, pet.type_pet.image_url) if card is not None else None
+        try:
+            message = await context.bot.send_photo(chat_id=update.effective_user.id,
+                                                   photo=photo or pet.type_pet.image_url,
+                                                   caption=answer)
+        except BadRequest as e:
+            if not isinstance(photo, str):
+                raise
+            logger.warning(f'Telegram не принял file_id карточки {card}: {e}')
+            pet_cards.forget(card)
+            photo = None
+            message = await context.bot.send_photo(chat_id=update.effective_user.id,
+                                                   photo=pet.type_pet.image_url,
+                                                   caption=answer)
+        if photo is not None:
+            pet_cards.remember(card, message)
         logger.info(f'Пользователь {update.effective_user.id} проверил состояние питомца')
 
-    async def _shutdown(self):
-        """ Закрывает приложение, ожидая завершение тасков, если такие имеются """
+    @staticmethod
+    @check_pet_exists
+    async def pet_history(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        """ /history
+            Выводит, как менялись характеристики питомца за последнюю неделю
+        """
+
+        rows = await get_stat_history(update.effective_user, 7)
+        await update.message.reply_text(render_history(rows or []))
+        logger.info(f'Пользователь {update.effective_user.id} посмотрел историю питомца')
+
+    @staticmethod
+    async def top_pets(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """ /top [happy|care]
+            Выводит рейтинг питомцев: самые счастливые (по умолчанию) или с лучшим уходом
+        """
+
+        board = context.args[0] if context.args and context.args[0] in BOARDS else 'happy'
+        rows = await get_leaderboard(board)
+        await update.message.reply_text(render_leaderboard(board, rows))
+        logger.info(f'Пользователь {update.effective_user.id} посмотрел рейтинг {board}')
+
+    async def set_profiling(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """ /profile [доля]
+            Команда администратора: включает выборочное профилирование доли апдейтов (0 - выключить)
+            Без аргумента показывает текущую долю. При выключении сохраняет накопленные профили
+        """
+
+        if context.args:
+            try:
+                sample_rate = float(context.args[0])
+            except ValueError:
+                await update.message.reply_text('Доля должна быть числом от 0 до 1')
+                return
+            self.profiler.sample_rate = min(max(sample_rate, 0.0), 1.0)
+            if not self.profiler.sample_rate:
+                self.profiler.flush()
+            logger.info(f'Пользователь {update.effective_user.id} установил долю профилирования '
+                        f'{self.profiler.sample_rate}')
+        await update.message.reply_text(f'Профилируется доля апдейтов: {self.profiler.sample_rate}')
+
+    @staticmethod
+    async def decay_history(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        """ /decay
+            Команда администратора: последние запуски уменьшения характеристик
+            (статус, длительность, обработано питомцев, ожидание блокировки, ошибки)
+        """
+
+        runs = await get_decay_runs(10)
+        if not runs:
+            await update.message.reply_text('Запусков уменьшения характеристик еще не было')
+            return
+        lines = []
+        for run in runs:
+            duration = (run.finished_at - run.started_at).total_seconds() if run.finished_at else None
+            lines.append(f'{run.started_at:%d.%m %H:%M} {run.status}: '
+                         f'{run.rows_processed} питомцев, '
+                         f'{f"{duration:.1f} с" if duration is not None else "идет"}, '
+                         f'блокировка {run.lock_wait or 0:.3f} с, ошибок {run.errors}')
+        await update.message.reply_text('\n'.join(lines))
+
+    async def runtime_stats(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        """ /stats
+            Команда администратора: состояние процесса бота
+            (состояния диалогов, очередь отправки, отброшенный флуд, нагрузка на бд)
+        """
 
-        tasks = asyncio.all_tasks()
+        sections = {'Состояния диалогов': conversation_state.stats(),
+                    'Очередь отправки': self.send_queue.stats(),
+                    'Бд': admission.stats(),
+                    'Карточки': pet_cards.stats()}
+        lines = []
+        for title, stats in sections.items():
+            lines.append(f'{title}: ' + ', '.join(f'{name} {value:.3f}' if isinstance(value, float) else f'{name} {value}'
+                                                 for name, value in stats.items()))
+        lines.append(f'Отброшено апдейтов флуда: {self.flood_guard.dropped}')
+        await update.message.reply_text('\n'.join(lines))
+
+    async def notify_awakened_pets(self) -> None:
+        """ Будит выспавшихся питомцев и сообщает об этом хозяевам """
+
+        awakened = await wake_up_pets() or []
+        if PET_EVENTS_ENABLED:
+            # Хозяев уведомит обработчик события woke_up. Он работает только в первом процессе,
+            # а задачи может выполнять любой, поэтому проверяется настройка, а не свой обработчик
+            return
+        for telegram_id, pet_name in awakened:
+            try:
+                await self.application.bot.send_message(telegram_id,
+                                                        f'{pet_name} проснулся и готов играть! /play',
+                                                        rate_limit_args=BULK)
+            except Exception as e:
+                logger.warning(f'Не удалось отправить уведомление о пробуждении пользователю {telegram_id}: {e}')
+
+    def _create_pet_event_listener(self) -> PetEventListener:
+        """ Подписка на события питомцев с уведомлением хозяев """
+
+        messages = {'sick': '{name}: мне плохо, кажется я заболел... Вылечи меня /therapy',
+                    'woke_up': '{name} проснулся и готов играть! /play',
+                    'hungry': '{name}: я очень проголодался, покорми меня /feed'}
+
+        def notify(template: str):
+            async def handler(event: dict) -> None:
+                await self.application.bot.send_message(event['telegram_id'],
+                                                        template.format(name=event.get('name') or 'Питомец'),
+                                                        rate_limit_args=BULK)
+            return handler
+
+        listener = PetEventListener()
+        for event, template in messages.items():
+            listener.add_handler(event, notify(template))
+        return listener
+
+    def _track(self, callback):
+        """ Запоминает апдейты, которые обрабатываются прямо сейчас, чтобы дождаться их при остановке
+            или отменить, если они не уложились в SHUTDOWN_TIMEOUT
+        """
+
+        @wraps(callback)
+        async def wrapper(*args, **kwargs):
+            task = asyncio.current_task()
+            self._in_flight.add(task)
+            try:
+                return await callback(*args, **kwargs)
+            finally:
+                self._in_flight.discard(task)
+
+        return wrapper
+
+    async def _on_start(self) -> None:
+        """ Выполняется после инициализации приложения, до начала получения апдейтов.
+            Апдейты начинают обрабатываться только после прогрева
+        """
+
+        if self.readiness is not None:
+            await self.readiness.start()
+        if self.recorder is not None:
+            self.recorder.start()
+        await event_log.start()
+        await stat_history.start()
+        await conversation_state.start()
+        if self.scheduler is not None:
+            await self.scheduler.start()
+        if self.pet_events is not None:
+            await self.pet_events.start()
+        warm_up_seconds = await warm_up()
+        if self.readiness is not None:
+            self.readiness.mark_ready(warm_up_seconds)
+
+    async def _abort_updates(self) -> int:
+        """ Прекращает обработку апдейтов после SHUTDOWN_TIMEOUT: убирает из очереди еще не начатые
+            апдейты и отменяет выполняющиеся обработчики, чтобы они не обращались к бд после записи
+            буферов и закрытия пулов. Возвращает число потерянных апдейтов
+        """
+
+        queue = self.application.update_queue
+        pending = [queue.get_nowait() for _ in range(queue.qsize())]
+        for _ in pending:
+            queue.task_done()
+        # Последним в очереди лежит сигнал остановки приложения: возвращаем его, чтобы получение
+        # апдейтов завершилось, если в нем сейчас не выполняется обработчик
+        if pending:
+            queue.put_nowait(pending[-1])
+        tasks = list(self._in_flight)
+        for task in tasks:
+            task.cancel()
         if tasks:
-            await asyncio.gather(*tasks)
-        await self.application.shutdown()
+            await asyncio.wait(tasks, timeout=1)
+        return max(len(pending) - 1, 0) + len(tasks)
+
+    async def _shutdown(self) -> None:
+        """ Остановка без потери работы, не дольше SHUTDOWN_TIMEOUT:
+            1. бот перестает считаться готовым и получать апдейты, фоновые задачи останавливаются
+            2. уже полученные апдейты дообрабатываются, не уложившиеся в срок отменяются
+            3. буферы журнала и истории характеристик записываются в бд
+            4. пулы подключений к бд закрываются
+            В конце в лог пишется, что не удалось обработать или записать
+        """
 
-    def run(self):
-        """ Запускает прослушивание бота,
-            а затем запускает закрытие, при попытке завершения работы программы
+        started = monotonic()
+        deadline = started + SHUTDOWN_TIMEOUT
+        if self.readiness is not None:
+            self.readiness.mark_not_ready()
+        updater = self.application.updater
+        if updater is not None and updater.running:
+            await updater.stop()
+        if self.pet_events is not None:
+            await self.pet_events.stop()
+        if self.scheduler is not None:
+            await self.scheduler.stop()
+
+        received = self.application.update_queue.qsize() + len(self._in_flight)
+        lost_updates = 0
+        if self.application.running:
+            try:
+                await asyncio.wait_for(self.application.stop(), timeout=max(deadline - monotonic(), 0))
+            except asyncio.TimeoutError:
+                lost_updates = await self._abort_updates()
+                logger.warning(f'Не все апдейты обработаны за {SHUTDOWN_TIMEOUT} с')
+
+        for buffer in (event_log, stat_history):
+            try:
+                # Запись буферов получает хотя бы секунду, даже если апдейты заняли все время
+                await asyncio.wait_for(buffer.stop(), timeout=max(deadline - monotonic(), 1))
+            except asyncio.TimeoutError:
+                logger.warning(f'Запись {buffer.table} не завершилась при остановке')
+        await conversation_state.stop()
+        if self.readiness is not None:
+            await self.readiness.stop()
+        if self.recorder is not None:
+            self.recorder.stop()
+
+        await engine.dispose()
+        for session_maker in replica_sessions:
+            await session_maker.kw['bind'].dispose()
+        self.profiler.flush()
+        logger.info(f'Бот остановлен за {monotonic() - started:.1f} с: '
+                    f'дообработано апдейтов {received - lost_updates}, потеряно {lost_updates}, '
+                    f'не записано строк журнала {event_log.pending}, истории {stat_history.pending}, '
+                    f'не отправлено сообщений {self.send_queue.pending}')
+
+    async def serve(self, updates: AsyncIterator[dict]) -> None:
+        """ Обрабатывает апдейты из внешнего источника вместо получения их самим ботом.
+            Используется процессами-обработчиками при шардировании, источник завершается при остановке
         """
 
+        async with self.application:
+            await self._on_start()
+            await self.application.start()
+            try:
+                async for data in updates:
+                    await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+            finally:
+                await self._shutdown()
+
+    async def _poll(self) -> None:
+        """ Получает апдейты через getUpdates до SIGINT/SIGTERM, затем останавливает бота """
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(stop_signal, stop.set)
+            except NotImplementedError:
+                # Windows: Ctrl+C отменяет ожидание, остановка выполняется так же
+                pass
+
+        async with self.application:
+            await self._on_start()
+            await self.application.start()
+            await self.application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            logger.info('Бот запущен')
+            try:
+                await stop.wait()
+                logger.info('Получен сигнал остановки')
+            finally:
+                await self._shutdown()
+
+    def run(self):
+        """ Запускает прослушивание бота и останавливает его по сигналу завершения работы программы """
+
         try:
             logger.info('Запуск бота...')
-            self.application.run_polling()
+            asyncio.run(self._poll())
+        except KeyboardInterrupt:
+            pass
         except Exception as e:
             logger.error(f'При работе бота возникла ошибка: {e}')
         finally:
-            asyncio.run(self._shutdown())
             logger.info('Завершена работа бота')
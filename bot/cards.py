@@ -0,0 +1,249 @@
+""" Карточки состояния питомца: картинка питомца и подписанные полоски пяти характеристик.
+    Характеристики округляются до CARD_STEP, поэтому разных карточек немного: готовые карточки
+    хранятся в памяти (LRU) и на диске, а для уже отправленных запоминается file_id Telegram,
+    и повторная карточка отправляется без загрузки картинки.
+    Картинка типа питомца скачивается по image_url один раз и хранится рядом с карточками.
+    Рисование требует Pillow и шрифт с кириллицей (card_font), без Pillow или если картинку
+    питомца скачать не удалось, бот отправляет обычную картинку питомца
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import os
+
+from collections import OrderedDict
+from functools import cache
+from typing import NamedTuple
+
+import httpx
+
+from telegram import Message
+
+from utilites.logger import get_logger
+
+try:
+    from PIL import Image, ImageDraw, ImageFont, ImageOps
+except ImportError:
+    Image = ImageDraw = ImageFont = ImageOps = None
+
+logger = get_logger('cards', file_level=logging.DEBUG, console_level=logging.INFO)
+
+CARD_DIR = os.getenv('card_cache_dir', 'cards')
+CARD_FONT = os.getenv('card_font', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+CARD_STEP = 10
+ART_TIMEOUT = 10
+
+WIDTH, HEIGHT = 640, 300
+PADDING = 24
+ART_SIZE = HEIGHT - 2 * PADDING - 8
+BAR_HEIGHT = 14
+FONT_SIZE = 17
+TEXT = (60, 60, 60)
+BACKGROUND = (250, 247, 240)
+TRACK = (225, 222, 215)
+SICK_BORDER = (214, 69, 65)
+# Названия и цвета полосок в порядке характеристик: здоровье, настроение, чистота, энергия, сытость
+STAT_NAMES = ('Здоровье', 'Настроение', 'Чистота', 'Энергия', 'Сытость')
+# Шрифт Pillow по умолчанию не содержит кириллицы: без card_font подписи латиницей
+STAT_NAMES_LATIN = ('Health', 'Mood', 'Grooming', 'Energy', 'Satiety')
+STAT_COLORS = ((214, 69, 65), (245, 176, 65), (93, 173, 226), (88, 214, 141), (175, 122, 197))
+
+
+class CardKey(NamedTuple):
+    type_id: int
+    sick: bool
+    stats: tuple[int, int, int, int, int]
+
+    @property
+    def filename(self) -> str:
+        return f'v2-{self.type_id}-{int(self.sick)}-{"-".join(map(str, self.stats))}.png'
+
+
+def _bucket(value: int) -> int:
+    return max(0, min(100, round(value / CARD_STEP) * CARD_STEP))
+
+
+def card_key(pet) -> CardKey:
+    """ Ключ карточки для объекта UserTamagochi """
+
+    return CardKey(pet.type_id,
+                   bool(pet.sick),
+                   tuple(_bucket(value) for value in (pet.health, pet.happiness, pet.grooming, pet.energy, pet.hunger)))
+
+
+def _accent(type_id: int) -> tuple[int, int, int]:
+    """ Цвет полоски сверху карточки, постоянный для типа питомца """
+
+    digest = hashlib.md5(str(type_id).encode()).digest()
+    return tuple(96 + byte % 128 for byte in digest[:3])
+
+
+@cache
+def _font():
+    """ Шрифт подписей и названия характеристик для него """
+
+    try:
+        return ImageFont.truetype(CARD_FONT, FONT_SIZE), STAT_NAMES
+    except OSError:
+        logger.warning(f'Шрифт {CARD_FONT} не найден, подписи на карточках будут латиницей')
+        return ImageFont.load_default(FONT_SIZE), STAT_NAMES_LATIN
+
+
+def render_card(key: CardKey, art: bytes) -> bytes:
+    """ Рисует карточку с картинкой питомца art слева и полосками характеристик справа, возвращает PNG """
+
+    image = Image.new('RGB', (WIDTH, HEIGHT), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, WIDTH, 8), fill=_accent(key.type_id))
+    with Image.open(io.BytesIO(art)) as pet_image:
+        pet_image = ImageOps.fit(pet_image.convert('RGB'), (ART_SIZE, ART_SIZE))
+    image.paste(pet_image, (PADDING, PADDING + 8))
+    if key.sick:
+        draw.rectangle((0, 0, WIDTH - 1, HEIGHT - 1), outline=SICK_BORDER, width=6)
+
+    font, names = _font()
+    track_left = 2 * PADDING + ART_SIZE
+    track_right = WIDTH - PADDING
+    row_height = ART_SIZE / len(key.stats)
+    for row, (name, value, color) in enumerate(zip(names, key.stats, STAT_COLORS)):
+        row_top = PADDING + 8 + row * row_height
+        # Подпись над полоской: название слева, значение справа (округлено до CARD_STEP, как и полоска)
+        draw.text((track_left, row_top + 4), name, font=font, fill=TEXT)
+        draw.text((track_right, row_top + 4), str(value), font=font, fill=TEXT, anchor='ra')
+        top = int(row_top + row_height - BAR_HEIGHT - 8)
+        bottom = top + BAR_HEIGHT
+        draw.rounded_rectangle((track_left, top, track_right, bottom), radius=BAR_HEIGHT // 2, fill=TRACK)
+        if value:
+            fill_right = track_left + (track_right - track_left) * value / 100
+            draw.rounded_rectangle((track_left, top, fill_right, bottom), radius=BAR_HEIGHT // 2, fill=color)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+class CardCache:
+    """ Карточки по ключу: file_id уже отправленной карточки, иначе PNG из памяти, с диска
+        или нарисованный заново (в отдельном потоке, чтобы не блокировать event loop).
+        hits - карточки из file_id или памяти, disk_hits - прочитанные с диска
+    """
+
+    def __init__(self, directory: str = CARD_DIR, max_images: int = 256, max_file_ids: int = 4096):
+        self.directory = directory
+        self.max_images = max_images
+        self.max_file_ids = max_file_ids
+        self._images: OrderedDict[CardKey, bytes] = OrderedDict()
+        self._file_ids: OrderedDict[CardKey, str] = OrderedDict()
+        self._arts: dict[int, bytes] = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.renders = 0
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None
+
+    async def photo(self, key: CardKey, art_url: str) -> str | bytes | None:
+        """ file_id или PNG карточки, None - если карточку получить не удалось.
+            art_url - картинка типа питомца, нужна только если карточку придётся рисовать
+        """
+
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+            self.hits += 1
+            return file_id
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+            self.hits += 1
+            return image
+        try:
+            image = await asyncio.to_thread(self._load, key)
+            if image is None:
+                art = await self._art(key.type_id, art_url)
+                if art is None:
+                    return None
+                image = await asyncio.to_thread(self._render, key, art)
+        except Exception as e:
+            logger.error(f'Не удалось нарисовать карточку {key}: {e}')
+            return None
+        self._images[key] = image
+        if len(self._images) > self.max_images:
+            self._images.popitem(last=False)
+        return image
+
+    def remember(self, key: CardKey, message: Message) -> None:
+        """ Запоминает file_id отправленной карточки. PNG в памяти больше не нужен """
+
+        if not message.photo:
+            return
+        self._file_ids[key] = message.photo[-1].file_id
+        if len(self._file_ids) > self.max_file_ids:
+            self._file_ids.popitem(last=False)
+        self._images.pop(key, None)
+
+    def forget(self, key: CardKey) -> None:
+        """ Удаляет file_id, который Telegram не принял """
+
+        self._file_ids.pop(key, None)
+
+    async def _art(self, type_id: int, url: str) -> bytes | None:
+        """ Картинка типа питомца: из памяти, с диска или скачанная по url. None - если скачать не удалось """
+
+        art = self._arts.get(type_id)
+        if art is not None:
+            return art
+        path = os.path.join(self.directory, f'art-{type_id}')
+        art = await asyncio.to_thread(self._read, path)
+        if art is None:
+            try:
+                async with httpx.AsyncClient(timeout=ART_TIMEOUT, follow_redirects=True) as client:
+                    response = await client.get(url)
+                    response.raise_for_status()
+            except httpx.HTTPError as e:
+                logger.warning(f'Не удалось скачать картинку типа {type_id} ({url}): {e}')
+                return None
+            art = response.content
+            await asyncio.to_thread(self._write, path, art)
+        self._arts[type_id] = art
+        return art
+
+    def _load(self, key: CardKey) -> bytes | None:
+        image = self._read(os.path.join(self.directory, key.filename))
+        if image is not None:
+            self.disk_hits += 1
+        return image
+
+    def _render(self, key: CardKey, art: bytes) -> bytes:
+        image = render_card(key, art)
+        self.renders += 1
+        self._write(os.path.join(self.directory, key.filename), image)
+        return image
+
+    @staticmethod
+    def _read(path: str) -> bytes | None:
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def _write(self, path: str, data: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        # Запись через временный файл, чтобы другой процесс не прочитал недописанный файл
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+    def stats(self) -> dict:
+        return {'file_ids': len(self._file_ids),
+                'images': len(self._images),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'renders': self.renders}
+
+
+pet_cards = CardCache()
@@ -0,0 +1,88 @@
+""" HTTP-проверки состояния бота для оркестратора:
+    - /live - процесс запущен
+    - /ready - бот прогрет и обрабатывает апдейты (503, пока идет прогрев или остановка)
+    - /metrics - время запуска и готовность в текстовом формате Prometheus
+"""
+
+import asyncio
+import logging
+import os
+
+from time import monotonic
+
+from utilites.logger import get_logger
+
+logger = get_logger('health', file_level=logging.DEBUG, console_level=logging.INFO)
+
+HEALTH_PORT = int(os.getenv('health_port', 8000))
+
+
+class Readiness:
+    """ Готовность бота и минимальный HTTP-сервер для ее проверки.
+        Время запуска считается от импорта бота до окончания прогрева
+    """
+
+    def __init__(self, port: int = HEALTH_PORT):
+        self.port = port
+        self.created = monotonic()
+        self.ready = False
+        self.startup_seconds: float | None = None
+        self.warm_up_seconds: float | None = None
+        self._server: asyncio.AbstractServer | None = None
+
+    def mark_ready(self, warm_up_seconds: float) -> None:
+        self.warm_up_seconds = warm_up_seconds
+        self.startup_seconds = monotonic() - self.created
+        self.ready = True
+        logger.info(f'Бот готов: запуск {self.startup_seconds:.2f} с, из них прогрев {warm_up_seconds:.2f} с')
+
+    def mark_not_ready(self) -> None:
+        self.ready = False
+
+    async def start(self) -> None:
+        if not self.port:
+            return
+        try:
+            self._server = await asyncio.start_server(self._handle, port=self.port)
+            logger.info(f'Проверки состояния доступны на порту {self.port}')
+        except OSError as e:
+            logger.error(f'Не удалось открыть порт {self.port} для проверок состояния: {e}')
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def metrics(self) -> str:
+        lines = [f'pet_bot_ready {int(self.ready)}']
+        if self.startup_seconds is not None:
+            lines.append(f'pet_bot_startup_seconds {self.startup_seconds:.3f}')
+            lines.append(f'pet_bot_warm_up_seconds {self.warm_up_seconds:.3f}')
+        return '\n'.join(lines) + '\n'
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            parts = request_line.decode('latin-1').split()
+            path = parts[1] if len(parts) > 1 else ''
+            if path == '/live':
+                status, body = '200 OK', 'alive\n'
+            elif path == '/ready':
+                status, body = ('200 OK', 'ready\n') if self.ready else ('503 Service Unavailable', 'not ready\n')
+            elif path == '/metrics':
+                status, body = '200 OK', self.metrics()
+            else:
+                status, body = '404 Not Found', 'not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: text/plain; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n{body}'.encode())
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+readiness = Readiness()
@@ -0,0 +1,142 @@
+""" Промежуточные обработчики, которые выполняются до основных хендлеров бота """
+
+import logging
+import os
+
+from collections import OrderedDict
+from time import monotonic
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+from utilites.logger import get_logger
+from utilites.rate_limit import TokenBucket
+
+logger = get_logger('middleware', file_level=logging.DEBUG, console_level=logging.INFO)
+
+
+class _UserLimit(TokenBucket):
+    """ Token bucket пользователя + время последнего предупреждения о флуде """
+
+    __slots__ = ('warned',)
+
+    def __init__(self, rate: float, capacity: float):
+        super().__init__(rate, capacity)
+        self.warned = 0.0
+
+
+class FloodGuard:
+    """ Ограничивает частоту апдейтов от одного пользователя до любой работы с бд.
+        Лишние апдейты отбрасываются, пользователь получает не больше одного
+        предупреждения за warn_interval секунд.
+        Память ограничена: хранится не больше max_users последних пользователей (LRU)
+    """
+
+    def __init__(self,
+                 rate: float = float(os.getenv('flood_rate', 1)),
+                 burst: float = float(os.getenv('flood_burst', 5)),
+                 max_users: int = 100000,
+                 warn_interval: float = 10):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.warn_interval = warn_interval
+        self._limits: OrderedDict[int, _UserLimit] = OrderedDict()
+        self.dropped = 0
+
+    def _limit(self, user_id: int) -> _UserLimit:
+        limit = self._limits.get(user_id)
+        if limit is None:
+            limit = self._limits[user_id] = _UserLimit(self.rate, self.burst)
+            if len(self._limits) > self.max_users:
+                self._limits.popitem(last=False)
+        else:
+            self._limits.move_to_end(user_id)
+        return limit
+
+    async def __call__(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        if user is None:
+            return
+
+        limit = self._limit(user.id)
+        if not limit.try_acquire():
+            return
+
+        self.dropped += 1
+        now = monotonic()
+        if now - limit.warned >= self.warn_interval:
+            limit.warned = now
+            logger.info(f'Пользователь {user.id} превысил лимит запросов')
+            if update.callback_query:
+                await update.callback_query.answer('Не так быстро, я не успеваю!')
+            elif update.effective_message:
+                await update.effective_message.reply_text('Не так быстро, я не успеваю!')
+        elif update.callback_query:
+            await update.callback_query.answer()
+        raise ApplicationHandlerStop
+
+
+class CallbackDeduplicator:
+    """ Отбрасывает повторные нажатия inline-кнопок до любой работы с бд.
+        Клавиатуры бота одноразовые, поэтому повтором считается второй callback
+        на то же сообщение (двойное нажатие) или тот же callback id (повторная доставка).
+        Если обработка нажатия завершилась ошибкой, сообщение забывается, чтобы нажатие можно было повторить.
+        Ключи хранятся ttl секунд, но не больше max_size штук
+    """
+
+    def __init__(self, ttl: float = 600, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen: OrderedDict[tuple, float] = OrderedDict()
+        self.duplicates = 0
+
+    def _evict(self, now: float) -> None:
+        # TTL одинаковый для всех ключей, поэтому самые старые всегда в начале
+        while self._seen:
+            key, expires = next(iter(self._seen.items()))
+            if expires > now and len(self._seen) <= self.max_size:
+                break
+            del self._seen[key]
+
+    def seen(self, *keys: tuple) -> bool:
+        """ Проверяет, встречался ли хотя бы один из ключей, и запоминает их """
+
+        now = monotonic()
+        self._evict(now)
+        if any(key in self._seen for key in keys):
+            return True
+        for key in keys:
+            self._seen[key] = now + self.ttl
+        return False
+
+    @staticmethod
+    def _message_key(update: Update) -> tuple | None:
+        message = update.callback_query.message
+        return ('message', message.chat.id, message.message_id) if message is not None else None
+
+    async def on_error(self, update: object, _: ContextTypes.DEFAULT_TYPE) -> None:
+        """ Обработчик ошибок: клавиатура сообщения снова принимает нажатия """
+
+        if isinstance(update, Update) and update.callback_query is not None:
+            key = self._message_key(update)
+            if key is not None:
+                self._seen.pop(key, None)
+
+    async def __call__(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        query = update.callback_query
+        # Подтверждаем callback сразу, чтобы Telegram не повторял доставку
+        try:
+            await query.answer()
+        except TelegramError as e:
+            logger.debug(f'Не удалось подтвердить callback {query.id}: {e}')
+
+        keys = [('query', query.id)]
+        message_key = self._message_key(update)
+        if message_key is not None:
+            keys.append(message_key)
+        if self.seen(*keys):
+            self.duplicates += 1
+            logger.debug(f'Повторный callback от пользователя {update.effective_user.id} отброшен')
+            raise ApplicationHandlerStop
@@ -0,0 +1,100 @@
+""" Реакция на изменения состояния питомцев через LISTEN/NOTIFY.
+    Триггер pet_events_trigger отправляет уведомления в канал pet_events,
+    бот слушает канал на одном выделенном подключении и передает события обработчикам
+"""
+
+import asyncio
+import asyncpg
+import json
+import logging
+
+from collections import defaultdict
+from typing import Awaitable, Callable
+
+from database.methods import db_user, db_password, db_host, db_name
+from utilites.logger import get_logger
+
+logger = get_logger('pet_events', file_level=logging.DEBUG, console_level=logging.INFO)
+
+CHANNEL = 'pet_events'
+
+PetEventHandler = Callable[[dict], Awaitable[None]]
+
+
+class PetEventListener:
+    """ Держит одно подключение с LISTEN pet_events и асинхронно вызывает обработчики событий.
+        Пока ничего не меняется, не делает запросов к бд.
+        При потере подключения переподключается с нарастающей паузой
+    """
+
+    def __init__(self, max_reconnect_delay: float = 60):
+        self.max_reconnect_delay = max_reconnect_delay
+        self._handlers: dict[str, list[PetEventHandler]] = defaultdict(list)
+        self._connection: asyncpg.Connection | None = None
+        self._supervisor: asyncio.Task | None = None
+        self._lost = asyncio.Event()
+        self._pending: set[asyncio.Task] = set()
+
+    def add_handler(self, event: str, handler: PetEventHandler) -> None:
+        """ Регистрирует обработчик события (sick, woke_up, hungry) """
+
+        self._handlers[event].append(handler)
+
+    async def start(self) -> None:
+        self._supervisor = asyncio.create_task(self._supervise(), name='pet_events_listener')
+
+    async def stop(self) -> None:
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            await asyncio.gather(self._supervisor, return_exceptions=True)
+            self._supervisor = None
+        await self._close()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        logger.info('Прослушивание событий питомцев остановлено')
+
+    async def _supervise(self) -> None:
+        delay = 1.0
+        while True:
+            try:
+                self._lost.clear()
+                self._connection = await asyncpg.connect(f'postgresql://{db_user}:{db_password}@{db_host}/{db_name}')
+                self._connection.add_termination_listener(lambda _: self._lost.set())
+                await self._connection.add_listener(CHANNEL, self._on_notify)
+                logger.info(f'Подписка на канал {CHANNEL} установлена')
+                delay = 1.0
+                await self._lost.wait()
+                logger.warning(f'Подключение к каналу {CHANNEL} потеряно')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f'Ошибка подписки на канал {CHANNEL}: {e}')
+            await self._close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def _close(self) -> None:
+        connection, self._connection = self._connection, None
+        if connection is not None and not connection.is_closed():
+            try:
+                await connection.close()
+            except Exception as e:
+                logger.debug(f'Ошибка при закрытии подключения {CHANNEL}: {e}')
+
+    def _on_notify(self, _connection, _pid, _channel, payload: str) -> None:
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.warning(f'Некорректное событие питомца: {payload}')
+            return
+        for handler in self._handlers.get(event.get('event'), ()):
+            task = asyncio.create_task(self._dispatch(handler, event))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    @staticmethod
+    async def _dispatch(handler: PetEventHandler, event: dict) -> None:
+        try:
+            await handler(event)
+        except Exception as e:
+            logger.error(f'Ошибка при обработке события {event.get("event")}: {e}')
@@ -0,0 +1,108 @@
+""" Подготовка ответов бота: inline-клавиатуры и карточка состояния питомца """
+
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Iterable
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+STATS_HEADER = 'Я себя чувствую вот так:\n'
+STATS_BODY = ('Здоровье: {0}\n'
+              'Настроение: {1}\n'
+              'Чистота: {2}\n'
+              'Энергия: {3}\n'
+              'Сытость: {4}\n')
+
+# Шаблон собирается один раз для обоих вариантов строки о здоровье,
+# чтобы при рендере оставался единственный вызов format
+_STATS_TEMPLATES = {True: STATS_HEADER + STATS_BODY + 'Я заболел(',
+                    False: STATS_HEADER + STATS_BODY + 'Я здоров)'}
+
+
+def _render_stats(health: int, happiness: int, grooming: int, energy: int, hunger: int, sick: bool) -> str:
+    """ Рендерит блок характеристик по заранее собранному шаблону """
+
+    return _STATS_TEMPLATES[bool(sick)].format(health, happiness, grooming, energy, hunger)
+
+
+def render_stats(pet) -> str:
+    """ Возвращает блок характеристик питомца.
+        pet - словарь из pet_condition_update или объект UserTamagochi
+    """
+
+    if isinstance(pet, dict):
+        return _render_stats(pet['health'], pet['happiness'], pet['grooming'],
+                             pet['energy'], pet['hunger'], pet['sick'])
+    return _render_stats(pet.health, pet.happiness, pet.grooming, pet.energy, pet.hunger, pet.sick)
+
+
+def render_action_result(pet: dict) -> str:
+    """ Возвращает ответ на действие с питомцем: реакция + блок характеристик """
+
+    return f'{pet["reaction"]}\n{render_stats(pet)}'
+
+
+def render_history(rows: list) -> str:
+    """ Возвращает историю характеристик: последние сутки по 4 часа, раньше - по дням """
+
+    if not rows:
+        return 'История пока пустая, загляни позже'
+
+    recent = datetime.now(timezone.utc) - timedelta(days=1)
+    groups: dict[datetime, list] = {}
+    for row in rows:
+        bucket = row.bucket
+        if bucket >= recent:
+            bucket = bucket.replace(hour=bucket.hour - bucket.hour % 4, minute=0, second=0, microsecond=0)
+        else:
+            bucket = bucket.replace(hour=0, minute=0, second=0, microsecond=0)
+        groups.setdefault(bucket, []).append(row)
+
+    lines = ['Как я себя чувствовал:', '❤️ здоровье 😊 настроение 🧼 чистота ⚡ энергия 🍽 сытость']
+    for bucket, group in groups.items():
+        samples = sum(row.samples for row in group)
+        health, happiness, grooming, energy, hunger = (
+            round(sum(getattr(row, stat) * row.samples for row in group) / samples)
+            for stat in ('health', 'happiness', 'grooming', 'energy', 'hunger'))
+        label = f'{bucket:%d.%m %H:%M}' if bucket >= recent else f'{bucket:%d.%m}'
+        lines.append(f'{label}: ❤️{health} 😊{happiness} 🧼{grooming} ⚡{energy} 🍽{hunger}')
+    return '\n'.join(lines)
+
+
+LEADERBOARD_TITLES = {'happy': 'Самые счастливые питомцы 😊',
+                      'care': 'Питомцы с лучшим уходом ❤️'}
+
+
+def render_leaderboard(board: str, rows: list) -> str:
+    """ Возвращает таблицу рейтинга питомцев """
+
+    if not rows:
+        return 'Рейтинг пока пустой'
+    lines = [LEADERBOARD_TITLES.get(board, board)]
+    lines.extend(f'{row.position}. {row.name} ({row.type_name}) - {row.score}' for row in rows)
+    return '\n'.join(lines)
+
+
+class KeyboardCache:
+    """ Кэш inline-клавиатуры для справочника.
+        Клавиатура строится один раз на версию справочника (кортеж его элементов)
+        и дальше переиспользуется: InlineKeyboardMarkup неизменяем
+    """
+
+    def __init__(self, build_button: Callable[[object], InlineKeyboardButton]):
+        self._build_button = build_button
+        self._version = None
+        self._markup = None
+
+    def get(self, items: Iterable) -> InlineKeyboardMarkup:
+        """ Возвращает клавиатуру, перестраивая ее только при изменении справочника """
+
+        version = tuple(items)
+        if version != self._version or self._markup is None:
+            self._markup = InlineKeyboardMarkup([[self._build_button(item)] for item in version])
+            self._version = version
+        return self._markup
+
+
+# В callback_data передается только id еды, чтобы укладываться в лимит Telegram в 64 байта
+food_keyboard = KeyboardCache(lambda food: InlineKeyboardButton(food[1], callback_data=f'food_{food[0]}'))
+pet_type_keyboard = KeyboardCache(lambda type_pet: InlineKeyboardButton(type_pet, callback_data=f'pet_{type_pet}'))
@@ -0,0 +1,158 @@
+""" Планировщик периодических задач внутри процесса бота.
+    Альтернатива celery beat + worker + RabbitMQ: задачи выполняются в event loop бота
+    и используют его пул подключений к бд. Включается переменной окружения scheduler=inprocess
+"""
+
+import asyncio
+import asyncpg
+import logging
+import random
+
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from database.methods import engine, DECAY_INTERVAL_SECONDS
+from database.pet_condition_update import reduction_stats, freeze_dormant_pets
+from database.stat_history import rollup_stat_history
+from database.leaderboard import refresh_leaderboard
+from utilites.logger import get_logger
+
+logger = get_logger('scheduler', file_level=logging.DEBUG, console_level=logging.INFO)
+
+# Ключ advisory-блокировки лидера: задачи выполняет только одна реплика бота
+LEADER_LOCK_KEY = 2_804_002
+
+
+@dataclass
+class ScheduledJob:
+    name: str
+    callback: Callable[[], Awaitable[None]]
+    interval: float
+    jitter: float
+
+
+class PetScheduler:
+    """ Запускает задачи с заданным интервалом и случайным разбросом (jitter),
+        чтобы несколько реплик и задач не обращались к бд одновременно.
+        Если реплик бота несколько, задачи выполняет только лидер - держатель advisory-блокировки
+        на отдельном подключении. При потере подключения лидерство переходит к другой реплике
+    """
+
+    def __init__(self, leader_retry_interval: float = 30):
+        self.leader_retry_interval = leader_retry_interval
+        self._jobs: list[ScheduledJob] = []
+        self._tasks: list[asyncio.Task] = []
+        self._leader_connection: AsyncConnection | None = None
+        self._is_leader = asyncio.Event()
+
+    @property
+    def is_leader(self) -> bool:
+        return self._is_leader.is_set()
+
+    def add_job(self, name: str, callback: Callable[[], Awaitable[None]], interval: float, jitter: float = 0.1):
+        """ Добавляет задачу, выполняемую раз в interval секунд ± jitter * interval """
+
+        self._jobs.append(ScheduledJob(name, callback, interval, jitter))
+
+    async def start(self) -> None:
+        self._tasks.append(asyncio.create_task(self._elect_leader(), name='scheduler_leader'))
+        for job in self._jobs:
+            self._tasks.append(asyncio.create_task(self._run_job(job), name=f'scheduler_{job.name}'))
+        logger.info(f'Планировщик запущен, задачи: {", ".join(job.name for job in self._jobs)}')
+
+    async def stop(self) -> None:
+        """ Отменяет задачи, дожидаясь их завершения, и освобождает лидерство """
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._release_leadership()
+        logger.info('Планировщик остановлен')
+
+    async def _elect_leader(self) -> None:
+        while True:
+            try:
+                if self._leader_connection is None:
+                    # AUTOCOMMIT, чтобы подключение лидера не висело в открытой транзакции
+                    connection = await engine.connect()
+                    await connection.execution_options(isolation_level='AUTOCOMMIT')
+                    locked = (await connection.execute(text('SELECT pg_try_advisory_lock(:key)'),
+                                                       {'key': LEADER_LOCK_KEY})).scalar()
+                    if locked:
+                        self._leader_connection = connection
+                        self._is_leader.set()
+                        logger.info('Реплика стала лидером планировщика')
+                    else:
+                        await connection.close()
+                else:
+                    # Проверка, что подключение с блокировкой живо
+                    await self._leader_connection.execute(text('SELECT 1'))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f'Ошибка выбора лидера планировщика: {e}')
+                await self._release_leadership()
+            await asyncio.sleep(self.leader_retry_interval)
+
+    async def _release_leadership(self) -> None:
+        self._is_leader.clear()
+        connection, self._leader_connection = self._leader_connection, None
+        if connection is None:
+            return
+        try:
+            # Закрытие возвращает подключение в пул, поэтому блокировку нужно снять явно
+            await connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': LEADER_LOCK_KEY})
+            await connection.close()
+        except Exception as e:
+            logger.warning(f'Не удалось освободить блокировку лидера: {e}')
+            await connection.invalidate()
+
+    async def _run_job(self, job: ScheduledJob) -> None:
+        while True:
+            delay = job.interval * (1 + random.uniform(-job.jitter, job.jitter))
+            await asyncio.sleep(delay)
+            if not self.is_leader:
+                continue
+            try:
+                logger.debug(f'Задача {job.name} запущена')
+                await job.callback()
+                logger.debug(f'Задача {job.name} завершена')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f'Ошибка при выполнении задачи {job.name}: {e}')
+
+
+async def decay_job() -> None:
+    """ Уменьшение характеристик питомцев на подключении из пула бота """
+
+    async with engine.connect() as connection:
+        raw_connection = await connection.get_raw_connection()
+        await reduction_stats(raw_connection.driver_connection)
+
+
+def on_pool_connection(job: Callable[[asyncpg.Connection], Awaitable]) -> Callable[[], Awaitable[None]]:
+    """ Задача, выполняемая на подключении asyncpg из пула бота, а не на отдельном подключении """
+
+    async def run() -> None:
+        async with engine.connect() as connection:
+            raw_connection = await connection.get_raw_connection()
+            await job(raw_connection.driver_connection)
+
+    return run
+
+
+def create_scheduler(wake_up_job: Callable[[], Awaitable[None]]) -> PetScheduler:
+    """ Планировщик со всеми задачами бота """
+
+    scheduler = PetScheduler()
+    scheduler.add_job('decay', decay_job, interval=DECAY_INTERVAL_SECONDS)
+    scheduler.add_job('wake_up', wake_up_job, interval=60, jitter=0.2)
+    scheduler.add_job('stat_history_rollup', on_pool_connection(rollup_stat_history), interval=3600)
+    scheduler.add_job('leaderboard_refresh', on_pool_connection(refresh_leaderboard), interval=300)
+    scheduler.add_job('freeze_dormant_pets', on_pool_connection(freeze_dormant_pets), interval=86400)
+    return scheduler
@@ -0,0 +1,252 @@
+""" Очередь исходящих запросов к Telegram с ограничением частоты.
+    Подключается к Application как rate limiter, поэтому все вызовы context.bot.*
+    и update.message.reply_* проходят через нее без изменения обработчиков
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import timedelta
+from time import monotonic
+from typing import Any, Callable, Coroutine
+
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+from utilites.logger import get_logger
+from utilites.rate_limit import TokenBucket
+
+logger = get_logger('send_queue', file_level=logging.DEBUG, console_level=logging.INFO)
+
+# Приоритеты: ответы пользователю обрабатываются раньше массовых уведомлений.
+# Передаются в методы бота через rate_limit_args, например rate_limit_args=BULK
+INTERACTIVE = 0
+BULK = 1
+LANES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+
+# Общий лимит бота. Если бот запущен несколькими процессами, лимит делится между ними
+GLOBAL_RATE = float(os.getenv('send_global_rate', 25))
+
+
+class SendDropped(TelegramError):
+    """ Запрос был отброшен очередью (переполнение или слишком долгое ожидание) """
+
+
+@dataclass(order=True)
+class _Job:
+    priority: int
+    seq: int
+    callback: Callable[..., Coroutine] = field(compare=False)
+    args: Any = field(compare=False)
+    kwargs: dict = field(compare=False)
+    chat_id: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued: float = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+
+class SendQueue(BaseRateLimiter[int]):
+    """ Очередь исходящих сообщений:
+        - глобальный token bucket (лимит Telegram ~30 сообщений в секунду)
+        - token bucket на каждый чат (~1 сообщение в секунду)
+        - при RetryAfter вся отправка приостанавливается на указанное время, запрос повторяется
+        - приоритетные полосы: INTERACTIVE раньше BULK, BULK может отбрасываться
+        Запросы без chat_id (getUpdates, answerCallbackQuery и т.п.) выполняются сразу
+    """
+
+    def __init__(self,
+                 global_rate: float = GLOBAL_RATE,
+                 chat_rate: float = float(os.getenv('send_chat_rate', 1)),
+                 chat_burst: float = 3,
+                 workers: int = 8,
+                 max_retries: int = 3,
+                 max_bulk_queue: int = 10000,
+                 max_bulk_wait: float = 600,
+                 max_chats: int = 50000):
+        # Емкость не меньше одного токена: при дробном лимите (GLOBAL_RATE / число процессов)
+        # ведро с емкостью rate < 1 никогда не накопило бы целый токен
+        self._global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._max_chats = max_chats
+        self._workers_count = workers
+        self._max_retries = max_retries
+        self._max_bulk_queue = max_bulk_queue
+        self._max_bulk_wait = max_bulk_wait
+
+        self._queue: asyncio.PriorityQueue | None = None
+        self._workers: list[asyncio.Task] = []
+        # Запросы, отложенные до восстановления лимита чата: seq -> (таймер, запрос)
+        self._delayed: dict[int, tuple[asyncio.TimerHandle, _Job]] = {}
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._depth = {lane: 0 for lane in LANES}
+
+        self.sent = 0
+        self.dropped = 0
+        self.retried = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    async def initialize(self) -> None:
+        # PTB вызывает initialize и для бота приложения, и для updater: второй вызов не должен терять воркеры
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._worker(), name=f'send_queue_{i}')
+                         for i in range(self._workers_count)]
+        logger.debug(f'Очередь отправки запущена, воркеров: {self._workers_count}')
+
+    async def shutdown(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for handle, job in self._delayed.values():
+            handle.cancel()
+            self._drop(job, 'остановка очереди')
+        self._delayed.clear()
+        if self._queue is not None:
+            while not self._queue.empty():
+                job = self._queue.get_nowait()
+                self._drop(job, 'остановка очереди')
+        logger.info(f'Очередь отправки остановлена: {self.stats()}')
+
+    async def process_request(self,
+                              callback: Callable[..., Coroutine],
+                              args: Any,
+                              kwargs: dict[str, Any],
+                              endpoint: str,
+                              data: dict[str, Any],
+                              rate_limit_args: int | None):
+        chat_id = data.get('chat_id')
+        if chat_id is None or self._queue is None:
+            return await callback(*args, **kwargs)
+
+        priority = BULK if rate_limit_args == BULK else INTERACTIVE
+        if priority == BULK and self._depth[BULK] >= self._max_bulk_queue:
+            self.dropped += 1
+            raise SendDropped(f'Очередь массовой отправки переполнена ({endpoint})')
+
+        job = _Job(priority=priority,
+                   seq=next(self._seq),
+                   callback=callback,
+                   args=args,
+                   kwargs=kwargs,
+                   chat_id=chat_id,
+                   future=asyncio.get_running_loop().create_future(),
+                   enqueued=monotonic())
+        self._put(job)
+        return await job.future
+
+    @property
+    def pending(self) -> int:
+        """ Сколько запросов ждет отправки """
+
+        return sum(self._depth.values()) + len(self._delayed)
+
+    def stats(self) -> dict:
+        """ Метрики очереди: глубина по полосам, отправлено, отброшено, повторы, задержка """
+
+        return {'depth': {LANES[lane]: depth for lane, depth in self._depth.items()},
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'retried': self.retried,
+                'latency_avg': self._latency_total / self.sent if self.sent else 0.0,
+                'latency_max': self._latency_max}
+
+    def _put(self, job: _Job) -> None:
+        self._depth[job.priority] += 1
+        self._queue.put_nowait(job)
+
+    def _requeue_later(self, job: _Job, delay: float) -> None:
+        handle = asyncio.get_running_loop().call_later(delay, self._put_delayed, job)
+        self._delayed[job.seq] = (handle, job)
+
+    def _put_delayed(self, job: _Job) -> None:
+        self._delayed.pop(job.seq, None)
+        self._put(job)
+
+    def _drop(self, job: _Job, reason: str) -> None:
+        self.dropped += 1
+        if not job.future.done():
+            job.future.set_exception(SendDropped(f'Запрос в чат {job.chat_id} отброшен: {reason}'))
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+            if len(self._chat_buckets) > self._max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            self._depth[job.priority] -= 1
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                self._drop(job, 'остановка очереди')
+                raise
+            except Exception as e:
+                logger.error(f'Ошибка в очереди отправки: {e}')
+                if not job.future.done():
+                    job.future.set_exception(e)
+
+    async def _process(self, job: _Job) -> None:
+        if job.future.done():
+            return
+        if job.priority == BULK and monotonic() - job.enqueued > self._max_bulk_wait:
+            self._drop(job, 'слишком долгое ожидание')
+            return
+
+        # Чат исчерпал свой лимит: возвращаем запрос в очередь позже, не блокируя остальные чаты
+        chat_delay = self._chat_bucket(job.chat_id).try_acquire()
+        if chat_delay:
+            self._requeue_later(job, chat_delay)
+            return
+
+        while True:
+            pause = self._paused_until - monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self._global_bucket.try_acquire()
+            if not delay:
+                break
+            await asyncio.sleep(delay)
+
+        try:
+            result = await job.callback(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            self._paused_until = max(self._paused_until, monotonic() + retry_after + 0.1)
+            if job.attempts >= self._max_retries:
+                logger.error(f'Превышено число повторов отправки в чат {job.chat_id}')
+                job.future.set_exception(e)
+                return
+            job.attempts += 1
+            self.retried += 1
+            logger.warning(f'Telegram просит подождать {retry_after} с, отправка приостановлена')
+            self._put(job)
+            return
+        except Exception as e:
+            job.future.set_exception(e)
+            return
+
+        latency = monotonic() - job.enqueued
+        self.sent += 1
+        self._latency_total += latency
+        self._latency_max = max(self._latency_max, latency)
+        job.future.set_result(result)
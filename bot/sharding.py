@@ -0,0 +1,156 @@
+""" Запуск бота несколькими процессами.
+    Один процесс получает апдейты через getUpdates и распределяет их по процессам-обработчикам
+    по telegram id пользователя: апдейты одного пользователя всегда попадают в один процесс
+    и обрабатываются по порядку. У каждого обработчика свой event loop и свой пул подключений к бд.
+    Включается переменной окружения bot_workers больше 1
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+
+from multiprocessing.context import SpawnProcess
+from multiprocessing.queues import Queue
+from queue import Full
+from time import monotonic
+from typing import AsyncIterator
+
+from telegram import Bot, Update
+
+from utilites.logger import get_logger
+
+logger = get_logger('sharding', file_level=logging.DEBUG, console_level=logging.INFO)
+
+BOT_WORKERS = int(os.getenv('bot_workers', 1))
+# Сколько апдейтов может ждать в очереди обработчика, дальше получение апдейтов приостанавливается
+QUEUE_SIZE = 1000
+POLL_TIMEOUT = 30
+STOP_TIMEOUT = 30
+PUT_RETRY_DELAY = 0.05
+
+# spawn, а не fork: обработчик не наследует event loop и подключения к бд родителя
+_context = multiprocessing.get_context('spawn')
+
+
+def shard_for(update: Update, shards: int) -> int:
+    """ Номер обработчика для апдейта. Апдейты без пользователя обрабатывает первый """
+
+    user = update.effective_user
+    return user.id % shards if user is not None else 0
+
+
+async def _queue_updates(queue: Queue) -> AsyncIterator[dict]:
+    loop = asyncio.get_running_loop()
+    while True:
+        payload = await loop.run_in_executor(None, queue.get)
+        if payload is None:
+            return
+        yield json.loads(payload)
+
+
+def _worker_main(shard: int, shards: int, queue: Queue) -> None:
+    """ Процесс-обработчик. Ctrl+C получает вся группа процессов,
+        поэтому обработчик его игнорирует и завершается, когда очередь закроет получатель
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from bot.bot import PetBot
+
+    logger.info(f'Обработчик {shard} запущен, pid {os.getpid()}')
+    asyncio.run(PetBot(shard, shards).serve(_queue_updates(queue)))
+    logger.info(f'Обработчик {shard} остановлен')
+
+
+class ShardedRunner:
+    """ Получает апдейты и распределяет их по shards процессам-обработчикам.
+        Упавший обработчик перезапускается с той же очередью, поэтому порядок апдейтов пользователя сохраняется
+    """
+
+    def __init__(self, token: str, shards: int = BOT_WORKERS):
+        self.token = token
+        self.shards = shards
+        self._queues: list[Queue] = [_context.Queue(QUEUE_SIZE) for _ in range(shards)]
+        self._workers: list[SpawnProcess | None] = [None] * shards
+
+    def run(self) -> None:
+        # docker stop отправляет SIGTERM только получателю: он останавливается так же, как по Ctrl+C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            for shard in range(self.shards):
+                self._start_worker(shard)
+            logger.info(f'Запуск бота, обработчиков: {self.shards}')
+            asyncio.run(self._poll())
+        except KeyboardInterrupt:
+            logger.info('Получен сигнал остановки')
+        except Exception as e:
+            logger.error(f'При получении апдейтов возникла ошибка: {e}')
+        finally:
+            asyncio.run(self._stop_workers())
+            logger.info('Завершена работа бота')
+
+    def _start_worker(self, shard: int) -> None:
+        worker = _context.Process(target=_worker_main,
+                                  args=(shard, self.shards, self._queues[shard]),
+                                  name=f'pet_bot_worker_{shard}')
+        worker.start()
+        self._workers[shard] = worker
+
+    def _check_workers(self) -> None:
+        for shard, worker in enumerate(self._workers):
+            if worker is not None and not worker.is_alive():
+                logger.error(f'Обработчик {shard} завершился с кодом {worker.exitcode}, перезапуск')
+                self._start_worker(shard)
+
+    async def _put(self, shard: int, payload: str | None, timeout: float | None = None) -> bool:
+        """ Кладет апдейт в очередь обработчика, не блокируя event loop.
+            Пока очередь заполнена, повторяет попытку с паузой и перезапускает упавшие обработчики.
+            Возвращает False, если за timeout секунд место в очереди не освободилось
+        """
+
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            try:
+                self._queues[shard].put_nowait(payload)
+                return True
+            except Full:
+                if deadline is not None and monotonic() >= deadline:
+                    return False
+                self._check_workers()
+                await asyncio.sleep(PUT_RETRY_DELAY)
+
+    async def _poll(self) -> None:
+        async with Bot(self.token) as bot:
+            offset = None
+            try:
+                while True:
+                    updates = await bot.get_updates(offset=offset,
+                                                    timeout=POLL_TIMEOUT,
+                                                    allowed_updates=Update.ALL_TYPES)
+                    self._check_workers()
+                    for update in updates:
+                        # Если очередь обработчика заполнена, получение апдейтов приостанавливается, но event loop не блокируется
+                        await self._put(shard_for(update, self.shards), update.to_json())
+                        offset = update.update_id + 1
+            finally:
+                if offset is not None:
+                    # Подтверждает Telegram получение последних апдейтов, чтобы они не пришли повторно
+                    await bot.get_updates(offset=offset, timeout=0)
+
+    async def _stop_workers(self) -> None:
+        """ Закрывает очереди и ждет, пока обработчики обработают уже полученные апдейты """
+
+        loop = asyncio.get_running_loop()
+        closed = await asyncio.gather(*(self._put(shard, None, STOP_TIMEOUT) for shard in range(self.shards)))
+        for shard, is_closed in enumerate(closed):
+            if not is_closed:
+                logger.warning(f'Очередь обработчика {shard} не освободилась за {STOP_TIMEOUT} с')
+        for shard, worker in enumerate(self._workers):
+            if worker is None:
+                continue
+            await loop.run_in_executor(None, worker.join, STOP_TIMEOUT)
+            if worker.is_alive():
+                logger.warning(f'Обработчик {shard} не завершился за {STOP_TIMEOUT} с, принудительная остановка')
+                worker.terminate()
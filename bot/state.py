@@ -0,0 +1,112 @@
+""" Состояние диалогов с пользователями (выбранный тип питомца, ожидание имени, загаданное место в прятках).
+    В отличие от context.user_data, записи живут ограниченное время и занимают ограниченную память:
+    брошенные на середине /create и /play не хранятся вечно
+"""
+
+import asyncio
+import logging
+import sys
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic
+from typing import Any
+
+from utilites.logger import get_logger
+
+logger = get_logger('state', file_level=logging.DEBUG, console_level=logging.INFO)
+
+# Примерный размер записи без ключа и значения: объект записи и место в словаре
+ENTRY_OVERHEAD = 150
+
+
+@dataclass(slots=True)
+class _Entry:
+    value: Any
+    expires: float
+    size: int
+
+
+class StateStore:
+    """ Хранилище значений по (telegram id, ключ):
+        - у каждой записи свой срок жизни (ttl), просроченные записи не возвращаются
+          и раз в sweep_interval секунд удаляются фоновой задачей
+        - общий размер ограничен max_bytes, при превышении удаляются давно не использованные записи (LRU)
+    """
+
+    def __init__(self, default_ttl: float = 900, max_bytes: int = 16 * 1024 * 1024, sweep_interval: float = 60):
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._entries: OrderedDict[tuple[int, str], _Entry] = OrderedDict()
+        self._sweeper: asyncio.Task | None = None
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, user_id: int, key: str, default: Any = None) -> Any:
+        entry = self._entries.get((user_id, key))
+        if entry is None:
+            return default
+        if entry.expires <= monotonic():
+            self._remove((user_id, key))
+            self.expirations += 1
+            return default
+        self._entries.move_to_end((user_id, key))
+        return entry.value
+
+    def set(self, user_id: int, key: str, value: Any, ttl: float | None = None) -> None:
+        """ Сохраняет значение на ttl секунд (по умолчанию default_ttl) """
+
+        self._remove((user_id, key))
+        size = sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_OVERHEAD
+        self._entries[(user_id, key)] = _Entry(value, monotonic() + (ttl or self.default_ttl), size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def pop(self, user_id: int, key: str, default: Any = None) -> Any:
+        value = self.get(user_id, key, default)
+        self._remove((user_id, key))
+        return value
+
+    def _remove(self, entry_key: tuple[int, str]) -> None:
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def sweep(self) -> int:
+        """ Удаляет просроченные записи, возвращает их количество """
+
+        now = monotonic()
+        expired = [entry_key for entry_key, entry in self._entries.items() if entry.expires <= now]
+        for entry_key in expired:
+            self._remove(entry_key)
+        self.expirations += len(expired)
+        return len(expired)
+
+    async def start(self) -> None:
+        self._sweeper = asyncio.create_task(self._run(), name='state_sweeper')
+
+    async def stop(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            expired = self.sweep()
+            if expired:
+                logger.debug(f'Удалено просроченных состояний диалогов: {expired}')
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries),
+                'bytes': self.bytes,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
+
+
+conversation_state = StateStore()
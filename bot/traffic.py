@@ -0,0 +1,339 @@
+""" Запись и воспроизведение реального трафика бота для сравнения производительности.
+    Запись включается переменной окружения record_traffic=<папка>: каждый апдейт сохраняется
+    со временем получения в <папка>/<время запуска>-<процесс>.ndjson.gz. id пользователей и чатов
+    заменяются псевдонимами, имена удаляются, текст сообщений (кроме команд) и подписи к медиа заменяются на x той же длины.
+
+    Воспроизведение - на заглушке Telegram API и локальной бд:
+    python -m bot.traffic replay traffic/*.ndjson.gz --speed 1|10|max --seed --report report.json
+"""
+
+import argparse
+import asyncio
+import gzip
+import heapq
+import hmac
+import json
+import logging
+import os
+import secrets
+
+from datetime import datetime
+from itertools import count
+from time import monotonic, strftime, time
+from typing import Any, AsyncIterator, Iterator
+
+from telegram import Update, User as TelegramUser
+from telegram.ext import ContextTypes, TypeHandler
+from telegram.request import BaseRequest, RequestData
+
+from utilites.logger import get_logger
+
+logger = get_logger('traffic', file_level=logging.DEBUG, console_level=logging.INFO)
+
+FORMAT = 'traffic-v1'
+RECORD_TRAFFIC = os.getenv('record_traffic')
+# Группа записи выполняется раньше всех промежуточных обработчиков, поэтому записывается и флуд
+RECORDER_GROUP = -3
+# Группа замера задержки при воспроизведении выполняется после основных хендлеров
+LATENCY_GROUP = 100
+
+# Поля с персональными данными, которые не записываются
+PRIVATE_FIELDS = {'first_name', 'last_name', 'username', 'title', 'phone_number', 'bio'}
+
+
+class TrafficRecorder:
+    """ Записывает входящие апдейты с обезличенными id в сжатый NDJSON.
+        Псевдоним id - HMAC со случайной для каждой записи солью: один и тот же пользователь
+        получает один псевдоним в пределах записи, а восстановить настоящий id нельзя
+    """
+
+    def __init__(self, directory: str, shard: int = 0):
+        self.path = os.path.join(directory, f'{strftime("%Y%m%d-%H%M%S")}-{shard}.ndjson.gz')
+        self._salt = secrets.token_bytes(16)
+        self._file = None
+        self.recorded = 0
+
+    def start(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._file = gzip.open(self.path, 'wt', encoding='utf-8')
+        self._file.write(json.dumps({'format': FORMAT, 'started_at': datetime.now().isoformat()}) + '\n')
+        logger.info(f'Запись трафика в {self.path}')
+
+    def stop(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info(f'Запись трафика остановлена, записано апдейтов: {self.recorded}')
+
+    async def __call__(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        if self._file is None:
+            return
+        self._file.write(json.dumps({'t': round(time(), 3), 'u': self._anonymize(update.to_dict())},
+                                    ensure_ascii=False, separators=(',', ':')) + '\n')
+        self.recorded += 1
+
+    def _pseudonym(self, value: int) -> int:
+        digest = hmac.new(self._salt, str(abs(value)).encode(), 'sha256').digest()
+        pseudonym = int.from_bytes(digest[:6], 'big') + 1
+        return -pseudonym if value < 0 else pseudonym
+
+    def _anonymize(self, data: Any) -> Any:
+        if isinstance(data, list):
+            return [self._anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        # Пользователь (есть is_bot) или чат (есть type): id заменяется псевдонимом
+        is_person = 'is_bot' in data or ('type' in data and isinstance(data.get('id'), int))
+        result = {}
+        for key, value in data.items():
+            if key in PRIVATE_FIELDS:
+                if key == 'first_name':
+                    result[key] = 'user'
+                continue
+            if (is_person and key == 'id') or key in ('chat_id', 'user_id'):
+                result[key] = self._pseudonym(value) if isinstance(value, int) else value
+            elif key == 'text' and isinstance(value, str) and not value.startswith('/'):
+                result[key] = 'x' * len(value)
+            elif key == 'caption' and isinstance(value, str):
+                result[key] = 'x' * len(value)
+            else:
+                result[key] = self._anonymize(value)
+        return result
+
+
+def read_traffic(paths: list[str]) -> Iterator[dict]:
+    """ Апдейты из нескольких файлов записи (например, от разных процессов) в порядке получения """
+
+    def read(path: str) -> Iterator[dict]:
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            header = json.loads(file.readline())
+            if header.get('format') != FORMAT:
+                raise ValueError(f'Неизвестный формат записи {path}: {header.get("format")}')
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+    return heapq.merge(*(read(path) for path in paths), key=lambda record: record['t'])
+
+
+class StubRequest(BaseRequest):
+    """ Заглушка Telegram Bot API: на каждый запрос сразу отвечает успехом без обращения к сети.
+        Отправленные сообщения и фото возвращаются как настоящие, api_latency - имитация задержки сети
+    """
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'PetBot', 'username': 'pet_replay_bot'}
+
+    def __init__(self, api_latency: float = 0):
+        self.api_latency = api_latency
+        self._message_ids = count(1)
+        self.calls: dict[str, int] = {}
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        parameters = request_data.parameters if request_data is not None else {}
+        if endpoint == 'getMe':
+            result = self.BOT_USER
+        elif endpoint.startswith(('send', 'edit')) and 'chat_id' in parameters:
+            result = {'message_id': next(self._message_ids),
+                      'date': int(time()),
+                      'chat': {'id': int(parameters['chat_id']), 'type': 'private'},
+                      'from': self.BOT_USER}
+            if endpoint == 'sendPhoto':
+                result['photo'] = [{'file_id': f'stub-{result["message_id"]}',
+                                    'file_unique_id': f'stub-{result["message_id"]}',
+                                    'width': 480,
+                                    'height': 240}]
+            else:
+                result['text'] = parameters.get('text', '')
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+def _update_kind(data: dict) -> str:
+    """ Команда, префикс callback-данных или message - для отчета по видам апдейтов """
+
+    message = data.get('message') or {}
+    text = message.get('text') or ''
+    if text.startswith('/'):
+        return text.split()[0].split('@')[0]
+    callback = data.get('callback_query')
+    if callback is not None:
+        return f'callback:{(callback.get("data") or "").split("_")[0]}'
+    return 'message'
+
+
+def _percentile(values: list[float], share: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def _latency_report(latencies: list[float]) -> dict:
+    latencies = sorted(latencies)
+    return {'count': len(latencies),
+            'p50_ms': round(_percentile(latencies, 0.5) * 1000, 2),
+            'p95_ms': round(_percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(_percentile(latencies, 0.99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0}
+
+
+# Виды апдейтов создания питомца: если пользователь начал с них, питомца на момент записи у него не было
+CREATE_FLOW_KINDS = {'/create', 'callback:pet'}
+
+
+async def _seed_users(records: list[dict]) -> None:
+    """ Создает в бд пользователей записи и питомцев для них, если их еще нет.
+        Питомец не создается пользователям, первый апдейт которых (не считая /start) - создание питомца:
+        иначе при воспроизведении они получили бы ответ "питомец уже есть" вместо создания
+    """
+
+    from database.methods import get_user, create_user, get_user_tamagochi, create_user_tamagochi, get_types_pet
+
+    types = await get_types_pet()
+    users = {}
+    # Вид первого апдейта пользователя, кроме /start
+    first_kinds = {}
+    for record in records:
+        user = Update.de_json(record['u'], None).effective_user
+        if user is not None and not user.is_bot:
+            users[user.id] = user
+            kind = _update_kind(record['u'])
+            if kind != '/start':
+                first_kinds.setdefault(user.id, kind)
+    with_pets = 0
+    for user in users.values():
+        telegram_user = TelegramUser(user.id, user.first_name, False)
+        if await get_user(telegram_user) is None:
+            await create_user(telegram_user)
+        if not types or first_kinds.get(user.id) in CREATE_FLOW_KINDS:
+            continue
+        if await get_user_tamagochi(telegram_user) is None:
+            await create_user_tamagochi(telegram_user, 'Питомец', types[user.id % len(types)])
+        with_pets += 1
+    logger.info(f'Подготовлено пользователей для воспроизведения: {len(users)}, из них с питомцем: {with_pets}')
+
+
+async def replay(paths: list[str], speed: float | None, seed: bool, api_latency: float) -> dict:
+    """ Воспроизводит запись на PetBot с заглушкой Telegram API и без ограничителей частоты
+        (FloodGuard, SendQueue): иначе при ускорении результат определяли бы их лимиты, а не сборка.
+        speed - ускорение относительно записи, None - без пауз между апдейтами.
+        Возвращает отчет: пропускная способность и задержка обработки апдейтов по видам.
+        Апдейт, обработчик которого упал, считается ошибкой. Апдейт, остановленный промежуточным
+        обработчиком (повторное нажатие кнопки, флуд), до замера задержки не доходит и считается отдельно
+    """
+
+    from bot.bot import PetBot
+
+    records = list(read_traffic(paths))
+    if not records:
+        raise ValueError('Запись пустая')
+    if seed:
+        await _seed_users(records)
+
+    stub = StubRequest(api_latency)
+    pet_bot = PetBot(request=stub, rate_limits=False)
+    # Воспроизведение не должно зависеть от фоновых задач и открывать порт проверок
+    pet_bot.scheduler = pet_bot.pet_events = pet_bot.readiness = None
+    pet_bot.recorder = None
+    application = pet_bot.application
+
+    enqueued: dict[int, tuple[float, str]] = {}
+    latencies: dict[str, list[float]] = {}
+    errors: set[int] = set()
+
+    async def probe(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        started, kind = enqueued.pop(update.update_id, (None, None))
+        if started is not None and update.update_id not in errors:
+            latencies.setdefault(kind, []).append(monotonic() - started)
+
+    async def on_error(update: object, _: ContextTypes.DEFAULT_TYPE) -> None:
+        if isinstance(update, Update):
+            errors.add(update.update_id)
+
+    application.add_handler(TypeHandler(Update, probe), group=LATENCY_GROUP)
+    application.add_error_handler(on_error)
+
+    replay_started = None
+
+    async def updates() -> AsyncIterator[dict]:
+        nonlocal replay_started
+        first_t = records[0]['t']
+        replay_started = monotonic()
+        for update_id, record in enumerate(records, start=1):
+            if speed is not None:
+                delay = replay_started + (record['t'] - first_t) / speed - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            # update_id переписывается, чтобы апдейты из разных файлов не совпадали
+            data = dict(record['u'], update_id=update_id)
+            enqueued[update_id] = (monotonic(), _update_kind(data))
+            yield data
+        await application.update_queue.join()
+
+    await pet_bot.serve(updates())
+    duration = monotonic() - replay_started
+    handled = sum(len(values) for values in latencies.values())
+    report = {'updates': len(records),
+              'handled': handled,
+              'stopped': len(records) - handled - len(errors),
+              'failed': len(errors),
+              'duration_s': round(duration, 3),
+              'throughput_per_s': round(handled / duration, 2) if duration else 0.0,
+              'latency': _latency_report([value for values in latencies.values() for value in values]),
+              'by_kind': {kind: _latency_report(values) for kind, values in sorted(latencies.items())},
+              'api_calls': stub.calls}
+    return report
+
+
+def _format_report(report: dict) -> str:
+    lines = [f'Апдейтов: {report["updates"]}, обработано: {report["handled"]}, '
+             f'остановлено: {report["stopped"]}, с ошибкой: {report["failed"]}',
+             f'Время: {report["duration_s"]} с, пропускная способность: {report["throughput_per_s"]} апдейтов/с',
+             'Задержка, мс:          count      p50      p95      p99      max']
+    for kind, latency in [('все', report['latency']), *report['by_kind'].items()]:
+        lines.append(f'  {kind:<20}{latency["count"]:>6}{latency["p50_ms"]:>9}{latency["p95_ms"]:>9}'
+                     f'{latency["p99_ms"]:>9}{latency["max_ms"]:>9}')
+    return '\n'.join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Воспроизведение записанного трафика бота')
+    commands = parser.add_subparsers(dest='command', required=True)
+    replay_parser = commands.add_parser('replay', help='воспроизвести запись на заглушке Telegram API')
+    replay_parser.add_argument('paths', nargs='+', help='файлы записи, например traffic/*.ndjson.gz')
+    replay_parser.add_argument('--speed', default='max', help='ускорение: 1 - как в записи, 10, max - без пауз')
+    replay_parser.add_argument('--seed', action='store_true',
+                               help='создать в бд пользователей и питомцев из записи')
+    replay_parser.add_argument('--api-latency', type=float, default=0,
+                               help='имитация задержки Telegram API в секундах')
+    replay_parser.add_argument('--report', help='сохранить отчет в JSON для сравнения сборок')
+    args = parser.parse_args()
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    report = asyncio.run(replay(args.paths, speed, args.seed, args.api_latency))
+    print(_format_report(report))
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    if report['failed']:
+        # Сборка, часть апдейтов которой упала, нельзя сравнивать по скорости
+        raise SystemExit(f'Апдейтов с ошибкой: {report["failed"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@
 import logging
 
 from celery import Celery
+from database.methods import DECAY_INTERVAL_SECONDS
 from utilites.logger import get_logger
 
 logger = get_logger('celery_app', file_level=logging.DEBUG, console_level=logging.INFO)
@@ -24,7 +25,20 @@ app.conf.broker_connection_retry_on_startup = True
 app.conf.beat_schedule = {
     'update-pet-condition-every-30-minutes': {
         'task': 'tasks.update_pet_condition',
-        'schedule': 1800.0,  # Каждые 30 минут
+        # Каждые 30 минут. Пропущенные интервалы догоняются при следующем запуске
+        'schedule': float(DECAY_INTERVAL_SECONDS),
+    },
+    'rollup-pet-stat-history-every-hour': {
+        'task': 'tasks.rollup_pet_stat_history',
+        'schedule': 3600.0,
+    },
+    'refresh-pet-leaderboard-every-5-minutes': {
+        'task': 'tasks.refresh_pet_leaderboard',
+        'schedule': 300.0,
+    },
+    'freeze-dormant-pets-every-day': {
+        'task': 'tasks.freeze_abandoned_pets',
+        'schedule': 86400.0,
     },
 }
 
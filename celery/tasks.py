@@ -5,7 +5,9 @@ import logging
 from asgiref.sync import async_to_sync
 from celery import shared_task
 
-from database.pet_condition_update import reduction_stats
+from database.pet_condition_update import reduction_stats, freeze_dormant_pets
+from database.stat_history import rollup_stat_history
+from database.leaderboard import refresh_leaderboard
 from utilites.logger import get_logger
 
 
@@ -20,3 +22,33 @@ def update_pet_condition():
         logger.debug('Задача update_pet_condition завершена!')
     except Exception as e:
         logger.error(f'Ошибка при выполнении задачи update_pet_condition: {e}')
+
+
+@shared_task
+def rollup_pet_stat_history():
+    try:
+        logger.debug('Задача rollup_pet_stat_history запущена!')
+        async_to_sync(rollup_stat_history)()
+        logger.debug('Задача rollup_pet_stat_history завершена!')
+    except Exception as e:
+        logger.error(f'Ошибка при выполнении задачи rollup_pet_stat_history: {e}')
+
+
+@shared_task
+def refresh_pet_leaderboard():
+    try:
+        logger.debug('Задача refresh_pet_leaderboard запущена!')
+        async_to_sync(refresh_leaderboard)()
+        logger.debug('Задача refresh_pet_leaderboard завершена!')
+    except Exception as e:
+        logger.error(f'Ошибка при выполнении задачи refresh_pet_leaderboard: {e}')
+
+
+@shared_task
+def freeze_abandoned_pets():
+    try:
+        logger.debug('Задача freeze_abandoned_pets запущена!')
+        async_to_sync(freeze_dormant_pets)()
+        logger.debug('Задача freeze_abandoned_pets завершена!')
+    except Exception as e:
+        logger.error(f'Ошибка при выполнении задачи freeze_abandoned_pets: {e}')
@@ -0,0 +1,167 @@
+""" Контроль нагрузки на бд.
+    Когда бд замедляется, запросы копятся в ожидании подключения из пула, и апдейты обрабатываются
+    с большим опозданием. Контроллер следит за числом запросов в работе и временем ожидания подключения:
+    при перегрузке второстепенная работа (время последнего запроса, пробуждение питомцев, запись журналов)
+    пропускается, а при отказах бд срабатывает автоматический выключатель, и пользователю сразу
+    отвечают, что бот занят, вместо долгого ожидания
+"""
+
+import asyncio
+import asyncpg
+import logging
+import os
+import random
+
+from time import monotonic
+
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+
+from utilites.logger import get_logger
+
+logger = get_logger('admission', file_level=logging.DEBUG, console_level=logging.INFO)
+
+# Ошибки, после которых бд может ответить при повторе: нет подключения, бд перегружена,
+# запрос прерван по statement_timeout, конфликт сериализации или взаимная блокировка.
+# Исчерпанный пул (TimeoutError SQLAlchemy) сюда не входит: повтор снова ждал бы pool_timeout
+TRANSIENT_ERRORS = (asyncio.TimeoutError,
+                    ConnectionError,
+                    OSError,
+                    asyncpg.PostgresConnectionError,
+                    asyncpg.TooManyConnectionsError,
+                    asyncpg.CannotConnectNowError,
+                    asyncpg.QueryCanceledError,
+                    asyncpg.SerializationError,
+                    asyncpg.DeadlockDetectedError)
+
+
+class DatabaseBusy(Exception):
+    """ Бд перегружена или недоступна, запрос не выполнялся """
+
+
+def is_transient(error: BaseException | None) -> bool:
+    if isinstance(error, PoolTimeoutError):
+        return False
+    if isinstance(error, DBAPIError):
+        if error.connection_invalidated:
+            return True
+        error = error.orig
+    # Ошибки asyncpg приходят обернутыми диалектом SQLAlchemy, исходная ошибка - в __cause__
+    return isinstance(error, TRANSIENT_ERRORS) or isinstance(getattr(error, '__cause__', None), TRANSIENT_ERRORS)
+
+
+class CircuitBreaker:
+    """ Автоматический выключатель: после failure_threshold отказов подряд запросы к бд
+        не выполняются reset_timeout секунд, затем пропускается один пробный запрос.
+        Успешный пробный запрос возвращает обычную работу
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """ Можно ли выполнить запрос. В полуоткрытом состоянии пропускает один пробный запрос """
+
+        if self._opened_at is None:
+            return True
+        if self._probing or monotonic() - self._opened_at < self.reset_timeout:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        if self._opened_at is not None:
+            logger.info('Бд снова отвечает, выключатель закрыт')
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._probing or (self._opened_at is None and self._failures >= self.failure_threshold):
+            logger.warning(f'Бд не отвечает ({self._failures} ошибок подряд), '
+                           f'запросы приостановлены на {self.reset_timeout} с')
+            self._opened_at = monotonic()
+        self._probing = False
+
+
+class AdmissionController:
+    """ Решает, выполнять ли запрос к бд.
+        - max_in_flight - сколько запросов одновременно считается нормальной нагрузкой (размер пула)
+        - max_wait - среднее время ожидания подключения из пула, выше которого бд считается перегруженной
+        - max_queue - сколько запросов может ждать подключения, дальше даже важные запросы отклоняются
+        Второстепенные запросы пропускаются при перегрузке, важные - только при открытом выключателе
+        или переполненной очереди
+    """
+
+    def __init__(self,
+                 max_in_flight: int = int(os.getenv('db_max_in_flight', 15)),
+                 max_wait: float = float(os.getenv('db_max_wait_ms', 500)) / 1000,
+                 max_queue: int = int(os.getenv('db_max_queue', 100)),
+                 retries: int = 2,
+                 retry_delay: float = 0.05):
+        self.max_in_flight = max_in_flight
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.breaker = CircuitBreaker()
+        self.in_flight = 0
+        self.wait_average = 0.0
+        self.shed = 0
+        self.rejected = 0
+
+    @property
+    def overloaded(self) -> bool:
+        return (self.breaker.is_open
+                or self.in_flight >= self.max_in_flight
+                or self.wait_average >= self.max_wait)
+
+    def admit(self, critical: bool) -> bool:
+        """ Занимает место для запроса. Возвращает False, если второстепенный запрос нужно пропустить,
+            и выбрасывает DatabaseBusy, если важный запрос выполнить нельзя
+        """
+
+        if not critical and self.overloaded:
+            self.shed += 1
+            return False
+        if self.in_flight >= self.max_queue or not self.breaker.allow():
+            self.rejected += 1
+            raise DatabaseBusy('Бд перегружена')
+        self.in_flight += 1
+        return True
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    def observe_wait(self, wait: float) -> None:
+        """ Учитывает время ожидания подключения (экспоненциальное скользящее среднее) """
+
+        self.wait_average += 0.2 * (wait - self.wait_average)
+        self.breaker.record_success()
+
+    def observe_failure(self) -> None:
+        self.breaker.record_failure()
+
+    def retry_delays(self):
+        """ Паузы перед повторами со случайным разбросом, чтобы повторы не приходили в бд одновременно """
+
+        for attempt in range(self.retries):
+            yield self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    def stats(self) -> dict:
+        return {'in_flight': self.in_flight,
+                'wait_average': self.wait_average,
+                'breaker_open': self.breaker.is_open,
+                'shed': self.shed,
+                'rejected': self.rejected}
+
+
+admission = AdmissionController()
@@ -8,6 +8,8 @@ from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from database.methods import engine, connection
+from database.event_log import create_event_log_table
+from database.leaderboard import create_leaderboard_view
 from database.models import (TypeTamagochi,
                              TypeFood,
                              Food,
@@ -24,8 +26,13 @@ async def initialize_database() -> None:
     """ Создает таблицы в бд и заполняет их данными для развертывания приложения в Docker """
 
     await create_tables()
+    await add_decay_watermark_columns()
+    await add_dormant_column()
     await create_trigger_and_func()
     await create_trigger_sick()
+    await create_trigger_pet_events()
+    await create_event_log_table()
+    await create_leaderboard_view()
     await populate_type_food_table()
     await populate_food_table()
     await populate_reaction_table()
@@ -45,6 +52,36 @@ async def create_tables() -> None:
         logger.debug(f'Ошибка при создании таблиц: {e}')
 
 
+async def add_decay_watermark_columns() -> None:
+    """ Добавляет колонки для учета примененных интервалов уменьшения характеристик
+        в таблицы, созданные до их появления
+    """
+
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text('ALTER TABLE user_tamagochi ADD COLUMN IF NOT EXISTS decay_tick BIGINT'))
+            await conn.execute(text('ALTER TABLE decay_run ADD COLUMN IF NOT EXISTS tick BIGINT'))
+        logger.debug('Колонки decay_tick и tick добавлены')
+    except Exception as e:
+        logger.error(f'Ошибка при добавлении колонок decay_tick и tick: {e}')
+
+
+async def add_dormant_column() -> None:
+    """ Добавляет флаг заморозки питомцев и частичный индекс активных питомцев
+        в таблицы, созданные до их появления
+    """
+
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text('ALTER TABLE user_tamagochi '
+                                    'ADD COLUMN IF NOT EXISTS dormant BOOLEAN NOT NULL DEFAULT false'))
+            await conn.execute(text('CREATE INDEX IF NOT EXISTS user_tamagochi_active_idx '
+                                    'ON user_tamagochi (id, decay_tick) WHERE NOT dormant'))
+        logger.debug('Колонка dormant добавлена')
+    except Exception as e:
+        logger.error(f'Ошибка при добавлении колонки dormant: {e}')
+
+
 async def create_trigger_and_func() -> None:
     """ Создает триггер для параметров питомца при первом создании БД """
 
@@ -109,6 +146,64 @@ async def create_trigger_sick() -> None:
         logger.error(f'Ошибка при создании триггера: {e}')
 
 
+async def create_trigger_pet_events() -> None:
+    """ Создает триггер, отправляющий NOTIFY в канал pet_events при важных изменениях питомца:
+        sick - заболел, woke_up - проснулся, hungry - сытость опустилась до 10 и ниже.
+        Уведомление содержит json с событием, telegram id хозяина и именем питомца
+    """
+
+    create_func_sql = """
+    CREATE OR REPLACE FUNCTION notify_pet_event()
+    RETURNS TRIGGER AS $$
+    DECLARE
+        events TEXT[] := ARRAY[]::TEXT[];
+        event TEXT;
+        telegram_id BIGINT;
+    BEGIN
+        IF NEW.sick AND NOT COALESCE(OLD.sick, FALSE) THEN
+            events := events || 'sick'::TEXT;
+        END IF;
+        IF OLD.sleep AND NOT COALESCE(NEW.sleep, FALSE) THEN
+            events := events || 'woke_up'::TEXT;
+        END IF;
+        IF NEW.hunger <= 10 AND OLD.hunger > 10 THEN
+            events := events || 'hungry'::TEXT;
+        END IF;
+        IF array_length(events, 1) IS NULL THEN
+            RETURN NULL;
+        END IF;
+
+        SELECT user_telegram_id INTO telegram_id FROM "user" WHERE id = NEW.owner_id;
+        FOREACH event IN ARRAY events LOOP
+            PERFORM pg_notify('pet_events', json_build_object('event', event,
+                                                              'telegram_id', telegram_id,
+                                                              'pet_id', NEW.id,
+                                                              'name', NEW.name)::TEXT);
+        END LOOP;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+
+    create_trigger_sql = """
+        CREATE TRIGGER pet_events_trigger
+        AFTER UPDATE ON user_tamagochi
+        FOR EACH ROW
+        WHEN (NEW.sick IS DISTINCT FROM OLD.sick
+              OR NEW.sleep IS DISTINCT FROM OLD.sleep
+              OR NEW.hunger IS DISTINCT FROM OLD.hunger)
+        EXECUTE FUNCTION notify_pet_event();
+        """
+
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text(create_func_sql))
+            await conn.execute(text(create_trigger_sql))
+            logger.debug('Триггер pet_events для user_tamagochi успешно создан')
+    except Exception as e:
+        logger.error(f'Ошибка при создании триггера: {e}')
+
+
 @connection
 async def populate_type_food_table(session: AsyncSession) -> None:
     """ Заполняет таблицу type_food при первом создании БД """
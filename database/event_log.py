@@ -0,0 +1,175 @@
+""" Журнал действий пользователей.
+    События копятся в памяти и пачками записываются через COPY в таблицу interaction_event,
+    секционированную по дням, поэтому запись события не добавляет запросов в обработку апдейта
+"""
+
+import asyncio
+import json
+import logging
+
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from database.admission import admission
+from database.methods import engine
+from utilites.logger import get_logger
+
+logger = get_logger('event_log', file_level=logging.DEBUG, console_level=logging.INFO)
+
+TABLE = 'interaction_event'
+COLUMNS = ('created_at', 'telegram_id', 'action', 'payload')
+
+CREATE_TABLE_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {TABLE} (
+        created_at TIMESTAMPTZ NOT NULL,
+        telegram_id BIGINT NOT NULL,
+        action VARCHAR(20) NOT NULL,
+        payload JSONB
+    ) PARTITION BY RANGE (created_at)
+"""
+# Секция по умолчанию принимает события, для дня которых секция еще не создана
+CREATE_DEFAULT_PARTITION_SQL = f'CREATE TABLE IF NOT EXISTS {TABLE}_default PARTITION OF {TABLE} DEFAULT'
+
+
+def partition_name(day: datetime) -> str:
+    return f'{TABLE}_{day:%Y%m%d}'
+
+
+async def create_event_log_table() -> None:
+    """ Создает секционированную таблицу журнала и секцию по умолчанию """
+
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text(CREATE_TABLE_SQL))
+            await conn.execute(text(CREATE_DEFAULT_PARTITION_SQL))
+            await conn.execute(text(f'CREATE INDEX IF NOT EXISTS {TABLE}_telegram_id_idx '
+                                    f'ON {TABLE} (telegram_id, created_at)'))
+        logger.debug(f'Таблица {TABLE} успешно создана')
+    except Exception as e:
+        logger.error(f'Ошибка при создании таблицы {TABLE}: {e}')
+
+
+class CopyBuffer:
+    """ Буфер строк с пакетной записью в таблицу через COPY.
+        Сбрасывается раз в flush_interval секунд или при накоплении batch_size строк.
+        Если бд недоступна, строки остаются в буфере, но не больше max_buffer (старые отбрасываются)
+    """
+
+    def __init__(self, table: str, columns: tuple[str, ...],
+                 flush_interval: float = 5, batch_size: int = 1000, max_buffer: int = 100000):
+        self.table = table
+        self.columns = columns
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self._buffer: list[tuple] = []
+        self._flusher: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self._flush_soon: asyncio.Task | None = None
+        self.written = 0
+        self.dropped = 0
+
+    @property
+    def pending(self) -> int:
+        """ Сколько строк ждет записи """
+
+        return len(self._buffer)
+
+    def append(self, record: tuple) -> None:
+        """ Добавляет строку в буфер. Не обращается к бд """
+
+        self._buffer.append(record)
+        if len(self._buffer) >= self.batch_size and self._flusher is not None \
+                and (self._flush_soon is None or self._flush_soon.done()):
+            self._flush_soon = asyncio.create_task(self.flush())
+
+    async def start(self) -> None:
+        self._flusher = asyncio.create_task(self._run(), name=f'{self.table}_flusher')
+
+    async def stop(self) -> None:
+        """ Останавливает фоновую запись и сбрасывает оставшиеся строки """
+
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        if self._flush_soon is not None:
+            await asyncio.gather(self._flush_soon, return_exceptions=True)
+        await self.flush()
+        if self._buffer:
+            logger.warning(f'Не записано строк {self.table} при остановке: {len(self._buffer)}')
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """ Записывает накопленные строки одним COPY """
+
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            if admission.overloaded and self._flusher is not None:
+                # Запись откладывается до следующего сброса, строки остаются в буфере
+                logger.debug(f'Бд перегружена, запись {self.table} отложена')
+                self._trim()
+                return
+            records, self._buffer = self._buffer, []
+            try:
+                async with engine.connect() as conn:
+                    raw_connection = (await conn.get_raw_connection()).driver_connection
+                    await self._prepare(raw_connection, records)
+                    await raw_connection.copy_records_to_table(self.table, records=records, columns=self.columns)
+                self.written += len(records)
+                logger.debug(f'Записано строк {self.table}: {len(records)}')
+            except Exception as e:
+                logger.error(f'Ошибка при записи {self.table}: {e}')
+                self._buffer = records + self._buffer
+                self._trim()
+
+    def _trim(self) -> None:
+        """ Отбрасывает самые старые строки сверх max_buffer """
+
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            del self._buffer[:overflow]
+            self.dropped += overflow
+
+    async def _prepare(self, raw_connection, records: list[tuple]) -> None:
+        """ Вызывается перед COPY на том же подключении """
+
+
+class EventLog(CopyBuffer):
+    """ Журнал действий пользователей с пакетной записью в секционированную таблицу """
+
+    def __init__(self, **kwargs):
+        super().__init__(TABLE, COLUMNS, **kwargs)
+        self._partitions: set[str] = set()
+
+    def emit(self, telegram_id: int, action: str, **payload) -> None:
+        """ Добавляет событие в буфер. Не обращается к бд """
+
+        self.append((datetime.now(timezone.utc),
+                     telegram_id,
+                     action,
+                     json.dumps(payload, ensure_ascii=False) if payload else None))
+
+    async def _prepare(self, raw_connection, records: list[tuple]) -> None:
+        """ Создает дневные секции для событий пачки, если их еще нет """
+
+        days = {record[0].replace(hour=0, minute=0, second=0, microsecond=0) for record in records}
+        for day in days:
+            name = partition_name(day)
+            if name in self._partitions:
+                continue
+            exists = await raw_connection.fetchval('SELECT to_regclass($1) IS NOT NULL', name)
+            if not exists:
+                await raw_connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {TABLE} "
+                    f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')")
+            self._partitions.add(name)
+
+
+event_log = EventLog()
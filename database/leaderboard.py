@@ -0,0 +1,112 @@
+""" Рейтинг питомцев.
+    Топ хранится в материализованном представлении pet_leaderboard, которое обновляется
+    по расписанию без блокировки чтения (REFRESH ... CONCURRENTLY).
+    Чтение рейтинга - K строк по индексу, результат дополнительно кэшируется в памяти
+"""
+
+import asyncpg
+import logging
+
+from time import monotonic
+from typing import NamedTuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.methods import connection, engine, raw_connection
+from utilites.logger import get_logger
+
+logger = get_logger('leaderboard', file_level=logging.DEBUG, console_level=logging.INFO)
+
+VIEW = 'pet_leaderboard'
+TOP_SIZE = 100
+CACHE_TTL = 60
+
+# Рейтинги: название -> выражение для очков питомца
+BOARDS = {
+    'happy': 'pet.happiness',
+    'care': 'pet.health + pet.happiness + pet.grooming + pet.energy + pet.hunger',
+}
+
+CREATE_VIEW_SQL = f"""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS {VIEW} AS
+    SELECT board, position, pet_id, name, type_name, score
+    FROM (
+        {' UNION ALL '.join(f'''
+        SELECT '{board}' AS board,
+               row_number() OVER (ORDER BY {score} DESC, pet.id) AS position,
+               pet.id AS pet_id,
+               pet.name,
+               pet_type.name AS type_name,
+               {score} AS score
+        FROM user_tamagochi AS pet
+        JOIN type_tamagochi AS pet_type ON pet_type.id = pet.type_id
+        WHERE NOT pet.dormant
+        ''' for board, score in BOARDS.items())}
+    ) AS ranked
+    WHERE position <= {TOP_SIZE}
+"""
+
+
+class LeaderboardRow(NamedTuple):
+    position: int
+    name: str
+    type_name: str
+    score: int
+
+
+# Рейтинг -> (когда устареет, сколько мест загружено, места)
+_cache: dict[str, tuple[float, int, list[LeaderboardRow]]] = {}
+
+
+async def create_leaderboard_view() -> None:
+    """ Создает материализованное представление рейтинга и уникальный индекс для обновления CONCURRENTLY """
+
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text(CREATE_VIEW_SQL))
+            await conn.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS {VIEW}_board_position_idx '
+                                    f'ON {VIEW} (board, position)'))
+        logger.debug(f'Представление {VIEW} успешно создано')
+    except Exception as e:
+        logger.error(f'Ошибка при создании представления {VIEW}: {e}')
+
+
+async def refresh_leaderboard(conn: asyncpg.Connection | None = None) -> None:
+    """ Пересчитывает рейтинг, не блокируя его чтение.
+        conn - подключение asyncpg из пула бота, без него открывается отдельное подключение
+    """
+
+    try:
+        async with raw_connection(conn) as conn:
+            await conn.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {VIEW}')
+        _cache.clear()
+        logger.debug('Рейтинг питомцев обновлен')
+    except Exception as e:
+        logger.error(f'Ошибка в refresh_leaderboard: {e}')
+
+
+@connection
+async def load_leaderboard(board: str, limit: int, session: AsyncSession) -> list[LeaderboardRow]:
+    """ Загружает первые limit мест рейтинга board """
+
+    try:
+        result = await session.execute(text(f'SELECT position, name, type_name, score FROM {VIEW} '
+                                            f'WHERE board = :board AND position <= :limit ORDER BY position'),
+                                       {'board': board, 'limit': limit})
+        return [LeaderboardRow(*row) for row in result.all()]
+    except Exception as e:
+        logger.error(f'Ошибка в load_leaderboard: {e}')
+
+
+async def get_leaderboard(board: str, limit: int = 10) -> list[LeaderboardRow]:
+    """ Возвращает первые limit мест рейтинга, кэшируя их на CACHE_TTL секунд """
+
+    cached = _cache.get(board)
+    if cached is not None and cached[0] > monotonic() and cached[1] >= limit:
+        return cached[2][:limit]
+    rows = await load_leaderboard(board, limit)
+    if rows is None:
+        return []
+    _cache[board] = (monotonic() + CACHE_TTL, limit, rows)
+    return rows
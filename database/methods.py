@@ -1,18 +1,27 @@
 """ Функции для запросов к базе данных, не изменяющих состояние питомца """
 
+import asyncio
+import asyncpg
+import itertools
 import logging
 import os
 import pytz
 import random
 
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
+from functools import wraps
+from time import monotonic
+from typing import NamedTuple
 from dotenv import load_dotenv
-from sqlalchemy import select, insert, update
+from sqlalchemy import select, insert, update, text, event
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import selectinload
-from telegram import _user
+from telegram import _user, User as TelegramUser
 
-from database.models import User, TypeTamagochi, UserTamagochi, Food, Reaction, HidingPlace
+from database.admission import admission, is_transient, DatabaseBusy
+from database.models import User, TypeTamagochi, UserTamagochi, Food, TypeFood, Reaction, HidingPlace, DecayRun
 from utilites.logger import get_logger
 
 logger = get_logger('methods', file_level=logging.DEBUG, console_level=logging.INFO)
@@ -23,27 +32,200 @@ db_name = os.getenv('db_name')
 db_user = os.getenv('db_user')
 db_password = os.getenv('db_password')
 DATABASE_URL = f'postgresql+asyncpg://{db_user}:{db_password}@{db_host}/{db_name}'
-engine = create_async_engine(url=DATABASE_URL, echo=False)
+# Сколько ждать свободного подключения из пула. Исчерпанный пул не повторяется,
+# поэтому пользователь узнает, что бот занят, через несколько секунд, а не через 30 по умолчанию
+DB_POOL_TIMEOUT = float(os.getenv('db_pool_timeout', 3))
+engine = create_async_engine(url=DATABASE_URL, echo=False, pool_timeout=DB_POOL_TIMEOUT)
 async_session = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
+# Реплики только для чтения, через запятую: db_replica_hosts=replica1:5432,replica2:5432
+db_replica_hosts = [host.strip() for host in os.getenv('db_replica_hosts', '').split(',') if host.strip()]
+replica_sessions = [
+    async_sessionmaker(bind=create_async_engine(url=f'postgresql+asyncpg://{db_user}:{db_password}@{host}/{db_name}',
+                                                echo=False,
+                                                pool_timeout=DB_POOL_TIMEOUT),
+                       class_=AsyncSession,
+                       expire_on_commit=False)
+    for host in db_replica_hosts
+]
+_replica_counter = itertools.count()
+
+# После изменения данных пользователь какое-то время читает с primary,
+# чтобы не увидеть устаревшее состояние из-за задержки репликации
+REPLICA_STICKY_SECONDS = float(os.getenv('db_replica_sticky_seconds', 5))
+_recent_writes: dict[int, float] = {}
+
+# Временные ошибки запросов текущего вызова @connection. Функции бд сами перехватывают свои ошибки
+# и возвращают None, поэтому ошибки запоминаются обработчиком handle_error engine
+_query_errors: ContextVar[list | None] = ContextVar('query_errors', default=None)
+
+
+def _on_query_error(context) -> None:
+    errors = _query_errors.get()
+    if errors is not None and (context.is_disconnect or is_transient(context.original_exception)):
+        errors.append(context.original_exception)
+
+
+for _engine in [engine, *(session_maker.kw['bind'] for session_maker in replica_sessions)]:
+    event.listen(_engine.sync_engine, 'handle_error', _on_query_error)
+
+# Функции с такими префиксами только читают данные и по умолчанию идут на реплику
+READ_ONLY_PREFIXES = ('get_', 'check_', 'load_')
+
 moscow_tz = pytz.timezone('Europe/Moscow')
 
+# Характеристики питомцев уменьшаются раз в интервал. Интервалы нумеруются от начала эпохи
+# по часам бд, номер последнего примененного хранится у питомца в decay_tick
+DECAY_INTERVAL_SECONDS = 1800
+CURRENT_DECAY_TICK_SQL = f'floor(extract(epoch FROM now()) / {DECAY_INTERVAL_SECONDS})::bigint'
+
+
+@asynccontextmanager
+async def raw_connection(conn: asyncpg.Connection | None = None):
+    """ Подключение asyncpg для фоновых задач: переданное conn (например, из пула бота)
+        или отдельное, которое закрывается после задачи. Пул engine привязан к event loop,
+        в котором он создан, а celery запускает каждую задачу через async_to_sync в новом loop
+    """
+
+    if conn is not None:
+        yield conn
+        return
+    conn = await asyncpg.connect(f'postgresql://{db_user}:{db_password}@{db_host}/{db_name}')
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+def _telegram_user_id(args: tuple) -> int | None:
+    """ Возвращает telegram id пользователя, если он передан первым аргументом """
+
+    if args and isinstance(args[0], TelegramUser):
+        return args[0].id
+    return None
+
+
+def _choose_session(read_only: bool, user_id: int | None) -> async_sessionmaker:
+    """ Выбирает фабрику сессий: реплика для чтения, primary для записи и сразу после записи """
+
+    if not read_only or not replica_sessions:
+        return async_session
+    if user_id is not None:
+        last_write = _recent_writes.get(user_id)
+        if last_write is not None:
+            if monotonic() - last_write < REPLICA_STICKY_SECONDS:
+                return async_session
+            del _recent_writes[user_id]
+    return replica_sessions[next(_replica_counter) % len(replica_sessions)]
+
+
+def _remember_write(user_id: int) -> None:
+    """ Запоминает время записи пользователя, попутно удаляя устаревшие отметки """
+
+    now = monotonic()
+    if len(_recent_writes) > 10000:
+        for stale_id in [uid for uid, ts in _recent_writes.items() if now - ts >= REPLICA_STICKY_SECONDS]:
+            del _recent_writes[stale_id]
+    _recent_writes[user_id] = now
+
+
+async def _open_session(session_maker: async_sessionmaker) -> AsyncSession:
+    """ Создает сессию и сразу берет подключение из пула, измеряя время ожидания.
+        Временные ошибки подключения повторяются с паузами, после чего выбрасывается DatabaseBusy.
+        Запросы до получения подключения не выполняются, поэтому повтор безопасен и для записи
+    """
+
+    delays = admission.retry_delays()
+    while True:
+        session = session_maker()
+        started = monotonic()
+        try:
+            await session.connection()
+        except Exception as e:
+            await session.close()
+            admission.observe_failure()
+            delay = next(delays, None)
+            if delay is None or not is_transient(e):
+                raise DatabaseBusy(f'Нет подключения к бд: {e}') from e
+            logger.warning(f'Нет подключения к бд, повтор через {delay:.2f} с: {e}')
+            await asyncio.sleep(delay)
+            continue
+        admission.observe_wait(monotonic() - started)
+        return session
+
+
+def connection(method=None, *, read_only: bool | None = None, critical: bool = True):
+    """ Декоратор для создания и передачи сессии в функции
+        Используется как @connection или @connection(read_only=True).
+        Если read_only не указан, он определяется по имени функции (get_*, check_*, load_*)
+        Чтения отправляются на реплику, если она настроена.
+        critical=False - второстепенная функция: при перегрузке бд она не выполняется и возвращает None.
+        Если бд перегружена или недоступна, важные функции выбрасывают DatabaseBusy.
+        Временные ошибки запросов (statement_timeout, обрыв подключения, конфликт сериализации)
+        тоже превращаются в DatabaseBusy, даже если функция перехватила их сама
+    """
 
-def connection(method):
-    """ Декоратор для создания и передачи сессии в функции """
+    def decorator(func):
+        is_read_only = func.__name__.startswith(READ_ONLY_PREFIXES) if read_only is None else read_only
 
-    async def wrapper(*args, **kwargs):
-        async with async_session() as session:
+        async def call(errors: list, *args, **kwargs):
+            seen = len(errors)
+            if not admission.admit(critical):
+                logger.debug(f'Бд перегружена, {func.__name__} пропущена')
+                return None
+            try:
+                user_id = _telegram_user_id(args)
+                session = await _open_session(_choose_session(is_read_only, user_id))
+                async with session:
+                    try:
+                        logger.debug('Открытие сессии')
+                        result = await func(*args, session=session, **kwargs)
+                    except Exception as e:
+                        await session.rollback()
+                        if not isinstance(e, DatabaseBusy) and not is_transient(e):
+                            logger.fatal(f'Ошибка при работе сессии бд: {e}')
+                            return None
+                        errors.append(e)
+                    finally:
+                        if not is_read_only and user_id is not None and replica_sessions:
+                            _remember_write(user_id)
+                        await session.close()
+                        logger.debug(f'Закрытие сессии')
+                    if len(errors) == seen:
+                        return result
+            finally:
+                admission.release()
+            error = errors[-1]
+            if not isinstance(error, DatabaseBusy):
+                admission.observe_failure()
+            if not critical:
+                del errors[seen:]
+                logger.warning(f'Ошибка бд, {func.__name__} пропущена: {error}')
+                return None
+            raise DatabaseBusy(f'Ошибка бд в {func.__name__}: {error}')
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            # Вложенные вызовы (функция бд, вызывающая другую) используют список ошибок внешнего вызова
+            errors = _query_errors.get()
+            token = None
+            if errors is None:
+                errors = []
+                token = _query_errors.set(errors)
             try:
-                logger.debug('Открытие сессии')
-                return await method(*args, session=session, **kwargs)
-            except Exception as e:
-                await session.rollback()
-                logger.fatal(f'Ошибка при работе сессии бд: {e}')
+                return await call(errors, *args, **kwargs)
+            except DatabaseBusy as e:
+                # Внешняя функция может перехватить DatabaseBusy сама, поэтому ошибка запоминается и для нее
+                errors.append(e)
+                raise
             finally:
-                await session.close()
-                logger.debug(f'Закрытие сессии')
-    return wrapper
+                if token is not None:
+                    _query_errors.reset(token)
+        return wrapper
+
+    if method is not None:
+        return decorator(method)
+    return decorator
 
 
 @connection
@@ -80,7 +262,8 @@ async def create_user_tamagochi(user: _user, name: str, type_pet: str, session:
             energy=pet_type_info.energy_max,
             hunger=pet_type_info.hunger_max,
             sick=False,
-            sleep=False
+            sleep=False,
+            decay_tick=text(CURRENT_DECAY_TICK_SQL)
         ).returning(UserTamagochi)
 
         result = await session.execute(stmt)
@@ -178,16 +361,63 @@ async def get_all_foods(session: AsyncSession) -> list[str]:
         logger.error(f'Ошибка в get_all_foods: {e}')
 
 
+class FoodEffect(NamedTuple):
+    """ Эффект еды на характеристики питомца """
+
+    name: str
+    up_stat: str
+    up_points: int
+    down_stat: str
+    down_points: int
+
+
+# Справочник еды не меняется во время работы бота, поэтому загружается один раз
+_food_catalog: dict[int, FoodEffect] | None = None
+
+
 @connection
+async def load_food_catalog(session: AsyncSession) -> dict[int, FoodEffect]:
+    """ Загружает справочник еды: id -> (название, повышаемая и понижаемая характеристики) """
+
+    try:
+        result = await session.execute(select(Food.id,
+                                              Food.name,
+                                              TypeFood.up_state_name,
+                                              TypeFood.up_state_point,
+                                              TypeFood.down_state_name,
+                                              TypeFood.down_state_point)
+                                       .join(TypeFood)
+                                       .order_by(Food.id))
+        catalog = {row.id: FoodEffect(row.name,
+                                      row.up_state_name,
+                                      row.up_state_point,
+                                      row.down_state_name,
+                                      row.down_state_point)
+                   for row in result.all()}
+        logger.debug(f'Загружен справочник еды: {len(catalog)} позиций')
+        return catalog
+    except Exception as e:
+        logger.error(f'Ошибка в load_food_catalog: {e}')
+
+
+async def get_food_catalog() -> dict[int, FoodEffect]:
+    """ Возвращает справочник еды из памяти, при первом обращении загружает его из бд """
+
+    global _food_catalog
+    if not _food_catalog:
+        _food_catalog = await load_food_catalog() or None
+    return _food_catalog or {}
+
+
+@connection(critical=False)
 async def update_user_last_request(user: _user, session: AsyncSession) -> None:
     """ Обновляет время последнего запроса у пользователя """
 
     try:
         current_time = datetime.now(moscow_tz)
-        result = await session.execute(select(User)
-                                       .where(User.user_telegram_id == user.id))
-        user = result.scalars().first()
-        user.last_request = current_time
+        await session.execute(update(User)
+                              .where(User.user_telegram_id == user.id)
+                              .values(last_request=current_time))
         logger.debug(f'Время последнего взаимодействия у пользователя {user.id} обновлено')
         await session.commit()
     except Exception as e:
@@ -236,11 +466,12 @@ async def get_hiding_places(session: AsyncSession) -> list[dict]:
         logger.error(f'Ошибка в get_hiding_places: {e}')
 
 
-@connection
+@connection(read_only=False)
 async def check_is_sleep(user: _user, session: AsyncSession) -> dict:
     """ Проверяет спит ли питомец в данный момент
         Если спит, то выводится реакция
         Со спящим питомцем нельзя взаимодействовать
+        Если питомец проспал 4 часа, он просыпается, поэтому функция выполняется на primary
     """
 
     try:
@@ -256,6 +487,7 @@ async def check_is_sleep(user: _user, session: AsyncSession) -> dict:
             if now - pet.time_sleep >= timedelta(hours=4):
                 pet.sleep = False
                 pet.time_sleep = None
+                await session.commit()
                 return {'sleep': False}
             else:
                 reaction = await get_reaction_to_action('sleep')
@@ -307,3 +539,16 @@ async def check_user_pet_energy(user: _user, session: AsyncSession) -> dict:
     except Exception as e:
         logger.error(f'Ошибка в check_user_pet_energy: {e}')
 
+
+
+@connection
+async def get_decay_runs(limit: int, session: AsyncSession) -> list[DecayRun]:
+    """ Возвращает последние запуски уменьшения характеристик, сначала новые """
+
+    try:
+        result = await session.execute(select(DecayRun)
+                                       .order_by(DecayRun.id.desc())
+                                       .limit(limit))
+        return list(result.scalars().all())
+    except Exception as e:
+        logger.error(f'Ошибка в get_decay_runs: {e}')
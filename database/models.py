@@ -1,6 +1,6 @@
 """ Модели базы данных """
 
-from sqlalchemy import Column, Integer, String, BigInteger, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, SmallInteger, String, BigInteger, DateTime, ForeignKey, Boolean, Float, Index
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
@@ -65,6 +65,9 @@ class UserTamagochi(Base):
             - sick - болезнь
             - sleep - спит ли сейчас питомец
             - time_sleep - время, когда уложили питомца спать
+            - decay_tick - номер последнего примененного интервала уменьшения характеристик
+            - dormant - питомец заморожен из-за долгой неактивности хозяина,
+                        уменьшение характеристик его не трогает до возвращения хозяина
     """
 
     __tablename__ = 'user_tamagochi'
@@ -80,10 +83,17 @@ class UserTamagochi(Base):
     sick = Column(Boolean, nullable=True)
     sleep = Column(Boolean, nullable=True, default=False)
     time_sleep = Column(DateTime(timezone=True), nullable=True)
+    decay_tick = Column(BigInteger, nullable=True)
+    dormant = Column(Boolean, nullable=False, default=False, server_default='false')
 
     owner = relationship('User', back_populates='user_pet')
     type_pet = relationship('TypeTamagochi', back_populates='pet')
 
+    __table_args__ = (
+        # Уменьшение характеристик и рейтинг обходят только активных питомцев
+        Index('user_tamagochi_active_idx', 'id', 'decay_tick', postgresql_where=dormant.is_(False)),
+    )
+
 
 class TypeFood(Base):
     """ Таблица type_food
@@ -145,3 +155,55 @@ class HidingPlace(Base):
     id = Column(Integer, primary_key=True)
     place = Column(String(100), nullable=True)
     reaction_found = Column(String(300), nullable=True)
+
+
+class DecayRun(Base):
+    """ Таблица decay_run
+        История запусков уменьшения характеристик питомцев:
+            - started_at - время запуска
+            - finished_at - время завершения
+            - status - running, success, skipped (уже идет другой запуск), error
+            - rows_processed - сколько питомцев обработано
+            - lock_wait - сколько секунд заняло получение блокировки
+            - errors - количество ошибок
+            - tick - до какого интервала уменьшения доведены питомцы
+    """
+
+    __tablename__ = 'decay_run'
+    id = Column(Integer, primary_key=True)
+    started_at = Column(DateTime(timezone=True), nullable=False)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    status = Column(String(20), nullable=False)
+    rows_processed = Column(Integer, nullable=False, default=0)
+    lock_wait = Column(Float, nullable=True)
+    errors = Column(Integer, nullable=False, default=0)
+    tick = Column(BigInteger, nullable=True)
+
+
+class PetStatHistory(Base):
+    """ Таблица pet_stat_history
+        История характеристик питомцев с прореживанием по давности:
+            - pet_id - питомец (user_tamagochi)
+            - tier - 0 - отдельные снимки (последние сутки), 1 - средние за час (месяц), 2 - средние за день
+            - bucket - время снимка или начало часа/дня
+            - health, happiness, grooming, energy, hunger - характеристики (средние для tier 1, 2)
+            - samples - сколько снимков усреднено
+    """
+
+    __tablename__ = 'pet_stat_history'
+    id = Column(BigInteger, primary_key=True)
+    pet_id = Column(Integer, ForeignKey('user_tamagochi.id', ondelete='CASCADE'), nullable=False)
+    tier = Column(SmallInteger, nullable=False)
+    bucket = Column(DateTime(timezone=True), nullable=False)
+    health = Column(SmallInteger, nullable=False)
+    happiness = Column(SmallInteger, nullable=False)
+    grooming = Column(SmallInteger, nullable=False)
+    energy = Column(SmallInteger, nullable=False)
+    hunger = Column(SmallInteger, nullable=False)
+    samples = Column(Integer, nullable=False, default=1)
+
+    __table_args__ = (
+        Index('pet_stat_history_pet_bucket_idx', 'pet_id', 'bucket'),
+        Index('pet_stat_history_rollup_idx', 'pet_id', 'tier', 'bucket', unique=True,
+              postgresql_where=tier > 0),
+    )
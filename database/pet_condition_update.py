@@ -1,62 +1,89 @@
 """ Функции для запросов к базе данных для изменения состояния питомца """
 
+import asyncio
 import asyncpg
 import logging
+import os
 
-from datetime import datetime
-from sqlalchemy import select
+from datetime import datetime, timedelta
+from time import monotonic
+from sqlalchemy import select, update, text
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
 from telegram import _user
 
-from .methods import moscow_tz, db_user, db_name, db_host, db_password, connection, get_reaction_to_action
-from .models import UserTamagochi, User, Food
+from .methods import (moscow_tz,
+                      db_user,
+                      db_name,
+                      db_host,
+                      db_password,
+                      connection,
+                      engine,
+                      raw_connection,
+                      get_reaction_to_action,
+                      get_food_catalog,
+                      CURRENT_DECAY_TICK_SQL,
+                      DECAY_INTERVAL_SECONDS)
+from .models import UserTamagochi, User
+from .stat_history import stat_history
 from utilites.logger import get_logger
 
 logger = get_logger('pet_conditions_update', file_level=logging.DEBUG, console_level=logging.INFO)
 
 
+# Сколько питомец спит после /sleep
+SLEEP_DURATION = timedelta(hours=4)
+
+# Характеристики, которые может менять еда
+FOOD_STATS = {'health', 'happiness', 'grooming', 'energy', 'hunger'}
+
+
 @connection
-async def feed_pet(user: _user, food: str, session: AsyncSession) -> dict:
+async def feed_pet(user: _user, food_id: int, session: AsyncSession) -> dict | None:
     """ Кормление питомца
         В зависимости от выбора еды,
-        повышает hunger и понижает 1 характеристику питомца
+        повышает hunger и понижает 1 характеристику питомца.
+        Эффект еды берется из справочника в памяти, изменение делается одним UPDATE
     """
 
     try:
-        user_pet_result = await session.execute(select(UserTamagochi)
-                                                .join(User)
-                                                .filter(User.user_telegram_id == user.id))
-        user_pet = user_pet_result.scalars().first()
+        food = (await get_food_catalog()).get(food_id)
+        if food is None:
+            logger.warning(f'Пользователь {user.id} выбрал неизвестную еду {food_id}')
+            return None
 
-        food_results = await session.execute(select(Food)
-                                             .where(Food.name == food)
-                                             .options(joinedload(Food.type_food))
-                                             )
-        food = food_results.scalars().first()
-        food_type = food.type_food
-
-        # Увеличение характеристик
-        current_value = getattr(user_pet, food_type.up_state_name, 0)
-        new_value = current_value + food_type.up_state_point
-        setattr(user_pet, food_type.up_state_name, new_value)
-
-        # Уменьшение характеристик
-        current_value = getattr(user_pet, food_type.down_state_name, 0)
-        new_value = current_value + food_type.down_state_point
-        setattr(user_pet, food_type.down_state_name, new_value)
+        changes = {}
+        for stat, points in ((food.up_stat, food.up_points), (food.down_stat, food.down_points)):
+            if stat not in FOOD_STATS:
+                raise ValueError(f'Неизвестная характеристика {stat} у еды {food_id}')
+            changes[stat] = changes.get(stat, getattr(UserTamagochi, stat)) + points
+
+        owner_id = select(User.id).where(User.user_telegram_id == user.id).scalar_subquery()
+        result = await session.execute(update(UserTamagochi)
+                                       .where(UserTamagochi.owner_id == owner_id)
+                                       .values(changes)
+                                       .returning(UserTamagochi.id,
+                                                  UserTamagochi.owner_id,
+                                                  UserTamagochi.health,
+                                                  UserTamagochi.happiness,
+                                                  UserTamagochi.grooming,
+                                                  UserTamagochi.energy,
+                                                  UserTamagochi.hunger,
+                                                  UserTamagochi.sick)
+                                       .execution_options(synchronize_session=False))
+        user_pet = result.one()
         await session.commit()
-        await session.refresh(user_pet)
         reaction = await get_reaction_to_action('fed')
         logger.debug(f'Обновлено состояние питомца пользователя {user_pet.owner_id} после кормления')
-        return {'health': user_pet.health,
-                'happiness': user_pet.happiness,
-                'grooming': user_pet.grooming,
-                'energy': user_pet.energy,
-                'hunger': user_pet.hunger,
-                'sick': user_pet.sick,
-                'reaction': reaction
-                }
+        result = {'health': user_pet.health,
+                  'happiness': user_pet.happiness,
+                  'grooming': user_pet.grooming,
+                  'energy': user_pet.energy,
+                  'hunger': user_pet.hunger,
+                  'sick': user_pet.sick,
+                  'reaction': reaction
+                  }
+        stat_history.record(user_pet.id, result)
+        return result
     except Exception as e:
         logger.error(f'Ошибка в feed_pet:{e}')
 
@@ -78,14 +105,16 @@ async def play_hide_and_seek(user: _user, session: AsyncSession) -> dict:
         await session.refresh(user_pet)
         logger.debug(f'Обновлено состояния питомца пользователя {user_pet.owner_id} после игры')
         reaction = await get_reaction_to_action('playing')
-        return {'health': user_pet.health,
-                'happiness': user_pet.happiness,
-                'grooming': user_pet.grooming,
-                'energy': user_pet.energy,
-                'hunger': user_pet.hunger,
-                'sick': user_pet.sick,
-                'reaction': reaction
-                }
+        result = {'health': user_pet.health,
+                  'happiness': user_pet.happiness,
+                  'grooming': user_pet.grooming,
+                  'energy': user_pet.energy,
+                  'hunger': user_pet.hunger,
+                  'sick': user_pet.sick,
+                  'reaction': reaction
+                  }
+        stat_history.record(user_pet.id, result)
+        return result
     except Exception as e:
         logger.error(f'Ошибка в play_hide_and_seek: {e}')
 
@@ -106,14 +135,16 @@ async def grooming_pet(user: _user, session: AsyncSession) -> dict:
         await session.refresh(user_pet)
         reaction = await get_reaction_to_action('grooming')
         logger.debug(f'Обновлено состояние питомца пользователя {user_pet.owner_id} после мытья')
-        return {'health': user_pet.health,
-                'happiness': user_pet.happiness,
-                'grooming': user_pet.grooming,
-                'energy': user_pet.energy,
-                'hunger': user_pet.hunger,
-                'sick': user_pet.sick,
-                'reaction': reaction
-                }
+        result = {'health': user_pet.health,
+                  'happiness': user_pet.happiness,
+                  'grooming': user_pet.grooming,
+                  'energy': user_pet.energy,
+                  'hunger': user_pet.hunger,
+                  'sick': user_pet.sick,
+                  'reaction': reaction
+                  }
+        stat_history.record(user_pet.id, result)
+        return result
     except Exception as e:
         logger.error(f'Ошибка в grooming_pet: {e}')
 
@@ -135,14 +166,16 @@ async def therapy(user: _user, session: AsyncSession) -> dict:
         await session.refresh(user_pet)
         reaction = await get_reaction_to_action('healing')
         logger.debug(f'Пользователь {user_pet.owner_id} вылечил своего питомца')
-        return {'health': user_pet.health,
-                'happiness': user_pet.happiness,
-                'grooming': user_pet.grooming,
-                'energy': user_pet.energy,
-                'hunger': user_pet.hunger,
-                'sick': user_pet.sick,
-                'reaction': reaction
-                }
+        result = {'health': user_pet.health,
+                  'happiness': user_pet.happiness,
+                  'grooming': user_pet.grooming,
+                  'energy': user_pet.energy,
+                  'hunger': user_pet.hunger,
+                  'sick': user_pet.sick,
+                  'reaction': reaction
+                  }
+        stat_history.record(user_pet.id, result)
+        return result
     except Exception as e:
         logger.error(f'Ошибка в therapy: {e}')
 
@@ -172,46 +205,286 @@ async def sleep(user: _user, session: AsyncSession) -> dict:
         logger.error(f'Ошибка в sleep: {e}')
 
 
-async def reduction_stats() -> None:
-    """ Уменьшение характеристик питомца о временем """
+@connection(critical=False)
+async def wake_up_pets(session: AsyncSession) -> list[tuple[int, str]]:
+    """ Будит питомцев, которые проспали 4 часа.
+        Возвращает telegram id хозяев и имена проснувшихся питомцев
+    """
 
     try:
-        logger.debug('Подключаемся к базе данных...')
+        result = await session.execute(update(UserTamagochi)
+                                       .where(UserTamagochi.owner_id == User.id,
+                                              UserTamagochi.sleep.is_(True),
+                                              UserTamagochi.time_sleep <= datetime.now(moscow_tz) - SLEEP_DURATION)
+                                       .values(sleep=False, time_sleep=None)
+                                       .returning(User.user_telegram_id, UserTamagochi.name)
+                                       .execution_options(synchronize_session=False))
+        awakened = [(row.user_telegram_id, row.name) for row in result.all()]
+        await session.commit()
+        if awakened:
+            logger.debug(f'Проснулось питомцев: {len(awakened)}')
+        return awakened
+    except Exception as e:
+        logger.error(f'Ошибка в wake_up_pets: {e}')
+
 
-        # Пришлось работать напрямую через asyncpg, так как обычная сессия с SQLAlchemy отрабатывала с ошибками
-        conn = await asyncpg.connect(f'postgresql://{db_user}:{db_password}@{db_host}/{db_name}')
+# Ключ advisory-блокировки, не дающей запускам уменьшения характеристик пересекаться
+DECAY_LOCK_KEY = 2_804_001
+# Уменьшение идет пачками, чтобы каждая транзакция держала блокировки строк недолго
+DECAY_BATCH_SIZE = int(os.getenv('decay_batch_size', 500))
+DECAY_STATEMENT_TIMEOUT_MS = int(os.getenv('decay_statement_timeout_ms', 2000))
+DECAY_RETRY_ROUNDS = 3
+# Сколько характеристик теряется за интервал и сколько интервалов максимум догоняется за раз.
+# Характеристики ограничены 0..100, поэтому больше 20 интервалов по 5 уже ничего не меняют
+DECAY_POINTS = 5
+DECAY_MAX_CATCH_UP_TICKS = 20
+# Снимок характеристик после уменьшения пишется в историю раз в час, а не на каждом интервале
+DECAY_HISTORY_EVERY_TICKS = max(1, 3600 // DECAY_INTERVAL_SECONDS)
+DECAY_RETRY_DELAY = 1.0
 
-        pets = await conn.fetch('SELECT * FROM user_tamagochi')
 
-        if not pets:
-            logger.warning('Нет питомцев в базе данных')
+async def reduction_stats(conn: asyncpg.Connection | None = None) -> None:
+    """ Уменьшение характеристик питомца о временем
+        Каждому питомцу применяются все интервалы, прошедшие с его decay_tick, ровно один раз:
+        после простоя celery это одно догоняющее уменьшение, а повторный запуск ничего не меняет.
+        Запуск защищен advisory-блокировкой Postgres: если предыдущий запуск еще идет
+        (долгий запуск или несколько celery beat), новый пропускается.
+        Каждый запуск записывается в decay_run.
+        conn - подключение asyncpg из пула бота, без него открывается отдельное подключение
+    """
+
+    own_connection = conn is None
+    run_id = None
+    try:
+        if own_connection:
+            logger.debug('Подключаемся к базе данных...')
+            # Пришлось работать напрямую через asyncpg, так как обычная сессия с SQLAlchemy отрабатывала с ошибками
+            conn = await asyncpg.connect(f'postgresql://{db_user}:{db_password}@{db_host}/{db_name}')
+
+        run_id = await conn.fetchval("""
+                INSERT INTO decay_run (started_at, status, rows_processed, errors)
+                VALUES (now(), 'running', 0, 0)
+                RETURNING id
+            """)
+
+        lock_started = monotonic()
+        locked = await conn.fetchval('SELECT pg_try_advisory_lock($1)', DECAY_LOCK_KEY)
+        lock_wait = monotonic() - lock_started
+        if not locked:
+            logger.warning('Предыдущее уменьшение характеристик еще не завершено, запуск пропущен')
+            await _finish_decay_run(conn, run_id, 'skipped', 0, lock_wait, 0)
             return
 
-        async with conn.transaction():
-            for pet in pets:
-                updated_stats = {
-                    'health': pet['health'] - 5,
-                    'happiness': pet['happiness'] - 5,
-                    'grooming': pet['grooming'] - 5,
-                    'hunger': pet['hunger'] - 5
-                }
-
-                # Обновление данных питомца в базе, используется вставка, а не f-string
-                await conn.execute("""
-                        UPDATE user_tamagochi
-                        SET health = $1, happiness = $2, grooming = $3, hunger = $4
-                        WHERE id = $5
-                    """,
-                                   updated_stats['health'],
-                                   updated_stats['happiness'],
-                                   updated_stats['grooming'],
-                                   updated_stats['hunger'],
-                                   pet['id'])
-        logger.info('Изменение характеристик питомцев прошло успешно!')
+        try:
+            tick = await conn.fetchval(f'SELECT {CURRENT_DECAY_TICK_SQL}')
+            rows_processed, errors = await _apply_decay(conn, tick)
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock($1)', DECAY_LOCK_KEY)
+
+        await _finish_decay_run(conn, run_id, 'success', rows_processed, lock_wait, errors, tick)
+        logger.info(f'Изменение характеристик питомцев прошло успешно! Обработано питомцев: {rows_processed}')
 
     except Exception as e:
         logger.error(f'Произошла ошибка в reduction_stats: {e}')
+        if conn is not None and run_id is not None and not conn.is_closed():
+            await _finish_decay_run(conn, run_id, 'error', 0, None, 1)
     finally:
-        if conn:
+        if own_connection and conn is not None:
             logger.info('Закрытие подключения к базе данных...')
             await conn.close()
+
+
+async def _finish_decay_run(conn: asyncpg.Connection,
+                            run_id: int,
+                            status: str,
+                            rows_processed: int,
+                            lock_wait: float | None,
+                            errors: int,
+                            tick: int | None = None) -> None:
+    """ Записывает результат запуска в decay_run """
+
+    await conn.execute("""
+            UPDATE decay_run
+            SET finished_at = now(), status = $2, rows_processed = $3, lock_wait = $4, errors = $5, tick = $6
+            WHERE id = $1
+        """, run_id, status, rows_processed, lock_wait, errors, tick)
+
+
+async def _apply_decay(conn: asyncpg.Connection, tick: int) -> tuple[int, int]:
+    """ Доводит характеристики всех питомцев до интервала tick небольшими пачками.
+        Каждая пачка - отдельная короткая транзакция, строки берутся через FOR UPDATE SKIP LOCKED,
+        поэтому уменьшение не ждет питомцев, с которыми сейчас взаимодействуют, и не блокирует их.
+        Пропущенные питомцы обрабатываются повторно в конце запуска.
+        Возвращает количество обработанных питомцев и количество ошибок
+    """
+
+    processed = 0
+    errors = 0
+    skipped = []
+    last_id = 0
+    while True:
+        rows = await conn.fetch("""
+                SELECT id FROM user_tamagochi
+                WHERE id > $1 AND NOT dormant AND (decay_tick IS NULL OR decay_tick < $3)
+                ORDER BY id
+                LIMIT $2
+            """, last_id, DECAY_BATCH_SIZE, tick)
+        if not rows:
+            break
+        batch = [row['id'] for row in rows]
+        last_id = batch[-1]
+        done, failed = await _decay_batch(conn, batch, tick)
+        processed += len(done)
+        errors += failed
+        skipped.extend(pet_id for pet_id in batch if pet_id not in done)
+
+    for retry in range(DECAY_RETRY_ROUNDS):
+        if not skipped:
+            break
+        await asyncio.sleep(DECAY_RETRY_DELAY * (retry + 1))
+        still_skipped = []
+        for i in range(0, len(skipped), DECAY_BATCH_SIZE):
+            batch = skipped[i:i + DECAY_BATCH_SIZE]
+            done, failed = await _decay_batch(conn, batch, tick)
+            processed += len(done)
+            errors += failed
+            still_skipped.extend(pet_id for pet_id in batch if pet_id not in done)
+        skipped = still_skipped
+
+    if skipped:
+        logger.warning(f'Не удалось обработать заблокированных питомцев: {len(skipped)}')
+    if not processed and not skipped:
+        logger.warning('Нет питомцев в базе данных')
+    return processed, errors
+
+
+async def _decay_batch(conn: asyncpg.Connection, pet_ids: list[int], tick: int) -> tuple[set[int], int]:
+    """ Применяет пачке питомцев все интервалы уменьшения с decay_tick до tick одним UPDATE.
+        Питомцы без decay_tick (созданные до его появления) получают один интервал.
+        В том же запросе новые характеристики записываются в историю pet_stat_history,
+        если tick - граница часа (DECAY_HISTORY_EVERY_TICKS).
+        Заблокированные строки пропускаются, время транзакции ограничено statement_timeout.
+        Возвращает id обработанных питомцев и количество ошибок (0 или 1)
+    """
+
+    try:
+        async with conn.transaction():
+            await conn.execute(f"SET LOCAL statement_timeout = '{DECAY_STATEMENT_TIMEOUT_MS}ms'")
+            rows = await conn.fetch("""
+                    WITH batch AS (
+                        SELECT id, LEAST($2 - COALESCE(decay_tick, $2 - 1), $3) * $4 AS points
+                        FROM user_tamagochi
+                        WHERE id = ANY($1::int[]) AND NOT dormant AND (decay_tick IS NULL OR decay_tick < $2)
+                        FOR UPDATE SKIP LOCKED
+                    ), updated AS (
+                        UPDATE user_tamagochi AS pet
+                        SET health = pet.health - batch.points,
+                            happiness = pet.happiness - batch.points,
+                            grooming = pet.grooming - batch.points,
+                            hunger = pet.hunger - batch.points,
+                            decay_tick = $2
+                        FROM batch
+                        WHERE pet.id = batch.id
+                        RETURNING pet.id, pet.health, pet.happiness, pet.grooming, pet.energy, pet.hunger
+                    ), history AS (
+                        INSERT INTO pet_stat_history
+                            (pet_id, tier, bucket, health, happiness, grooming, energy, hunger, samples)
+                        SELECT id, 0, now(), health, happiness, grooming, energy, hunger, 1
+                        FROM updated
+                        WHERE $2 % $5 = 0
+                    )
+                    SELECT id FROM updated
+                """, pet_ids, tick, DECAY_MAX_CATCH_UP_TICKS, DECAY_POINTS, DECAY_HISTORY_EVERY_TICKS)
+        return {row['id'] for row in rows}, 0
+    except (asyncpg.QueryCanceledError, asyncpg.DeadlockDetectedError) as e:
+        logger.warning(f'Пачка из {len(pet_ids)} питомцев будет обработана повторно: {e}')
+        return set(), 1
+
+
+# Через сколько дней неактивности хозяина питомец замораживается
+DORMANT_AFTER_DAYS = int(os.getenv('dormant_after_days', 30))
+DORMANT_BATCH_SIZE = 1000
+
+
+async def freeze_dormant_pets(conn: asyncpg.Connection | None = None) -> int:
+    """ Замораживает питомцев, хозяева которых не заходили больше DORMANT_AFTER_DAYS дней.
+        decay_tick не меняется: пропущенные интервалы применятся один раз при возвращении хозяина.
+        Пачки - отдельные короткие транзакции, заблокированные строки пропускаются.
+        conn - подключение asyncpg из пула бота, без него открывается отдельное подключение.
+        Возвращает количество замороженных питомцев
+    """
+
+    frozen = 0
+    try:
+        async with raw_connection(conn) as conn:
+            while True:
+                status = await conn.execute("""
+                        UPDATE user_tamagochi SET dormant = true
+                        WHERE id IN (
+                            SELECT pet.id
+                            FROM user_tamagochi AS pet
+                            JOIN "user" AS owner ON owner.id = pet.owner_id
+                            WHERE NOT pet.dormant
+                              AND owner.last_request < now() - make_interval(days => $1)
+                            LIMIT $2
+                            FOR UPDATE OF pet SKIP LOCKED
+                        )
+                    """, DORMANT_AFTER_DAYS, DORMANT_BATCH_SIZE)
+                # Статус выполнения asyncpg: 'UPDATE <число строк>'
+                updated = int(status.split()[-1])
+                frozen += updated
+                if updated < DORMANT_BATCH_SIZE:
+                    break
+        logger.info(f'Заморожено неактивных питомцев: {frozen}')
+    except Exception as e:
+        logger.error(f'Ошибка в freeze_dormant_pets: {e}')
+    return frozen
+
+
+@connection
+async def rehydrate_pet(user: _user, session: AsyncSession) -> dict | None:
+    """ Размораживает питомца вернувшегося пользователя.
+        Все интервалы уменьшения, пропущенные за время заморозки, применяются одним UPDATE
+        так же, как при обычном уменьшении характеристик. В той же транзакции обновляется
+        время последнего запроса хозяина, чтобы ночная заморозка не заморозила питомца снова
+    """
+
+    try:
+        await session.execute(update(User)
+                              .where(User.user_telegram_id == user.id)
+                              .values(last_request=datetime.now(moscow_tz)))
+        result = await session.execute(text(f"""
+                UPDATE user_tamagochi
+                SET health = health - points,
+                    happiness = happiness - points,
+                    grooming = grooming - points,
+                    hunger = hunger - points,
+                    decay_tick = pending.tick,
+                    dormant = false
+                FROM (
+                    SELECT pet.id AS pet_id,
+                           {CURRENT_DECAY_TICK_SQL} AS tick,
+                           GREATEST(LEAST({CURRENT_DECAY_TICK_SQL} - COALESCE(pet.decay_tick, {CURRENT_DECAY_TICK_SQL} - 1),
+                                          :max_ticks), 0) * :points AS points
+                    FROM user_tamagochi AS pet
+                    JOIN "user" AS owner ON owner.id = pet.owner_id
+                    WHERE owner.user_telegram_id = :telegram_id AND pet.dormant
+                ) AS pending
+                WHERE user_tamagochi.id = pending.pet_id
+                RETURNING user_tamagochi.id, health, happiness, grooming, energy, hunger, sick
+            """), {'telegram_id': user.id, 'max_ticks': DECAY_MAX_CATCH_UP_TICKS, 'points': DECAY_POINTS})
+        user_pet = result.one_or_none()
+        await session.commit()
+        if user_pet is None:
+            return None
+        result = {'health': user_pet.health,
+                  'happiness': user_pet.happiness,
+                  'grooming': user_pet.grooming,
+                  'energy': user_pet.energy,
+                  'hunger': user_pet.hunger,
+                  'sick': user_pet.sick}
+        stat_history.record(user_pet.id, result)
+        logger.info(f'Питомец пользователя {user.id} разморожен')
+        return result
+    except Exception as e:
+        logger.error(f'Ошибка в rehydrate_pet: {e}')
@@ -0,0 +1,104 @@
+""" История характеристик питомцев.
+    Снимки пишутся раз в час при уменьшении характеристик и после действий пользователя,
+    затем прореживаются: отдельные снимки хранятся сутки, средние за час - месяц, дальше средние за день
+"""
+
+import asyncpg
+import logging
+
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram import _user
+
+from database.event_log import CopyBuffer
+from database.methods import connection, raw_connection
+from database.models import PetStatHistory, User, UserTamagochi
+from utilites.logger import get_logger
+
+logger = get_logger('stat_history', file_level=logging.DEBUG, console_level=logging.INFO)
+
+RAW_TIER = 0
+HOUR_TIER = 1
+DAY_TIER = 2
+
+TABLE = PetStatHistory.__tablename__
+COLUMNS = ('pet_id', 'tier', 'bucket', 'health', 'happiness', 'grooming', 'energy', 'hunger', 'samples')
+STATS = ('health', 'happiness', 'grooming', 'energy', 'hunger')
+
+# (из какого уровня, в какой, через сколько переносить, до чего округлять время)
+ROLLUPS = ((RAW_TIER, HOUR_TIER, '1 day', 'hour'),
+           (HOUR_TIER, DAY_TIER, '30 days', 'day'))
+
+
+class StatHistory(CopyBuffer):
+    """ Снимки характеристик после действий пользователя, записываются пачками через COPY """
+
+    def __init__(self, **kwargs):
+        super().__init__(TABLE, COLUMNS, **kwargs)
+
+    def record(self, pet_id: int, pet: dict) -> None:
+        """ Добавляет снимок характеристик в буфер. Не обращается к бд """
+
+        self.append((pet_id, RAW_TIER, datetime.now(timezone.utc), *(pet[stat] for stat in STATS), 1))
+
+
+stat_history = StatHistory()
+
+
+def _rollup_sql(source: int, target: int, age: str, unit: str) -> str:
+    """ Переносит снимки старше age из уровня source в уровень target, усредняя их по unit.
+        Если в target уже есть запись за этот период, средние объединяются с учетом числа снимков
+    """
+
+    averages = ', '.join(f'round(sum({stat} * samples)::numeric / sum(samples))' for stat in STATS)
+    merge = ', '.join(f'{stat} = round(({TABLE}.{stat} * {TABLE}.samples + EXCLUDED.{stat} * EXCLUDED.samples)'
+                      f'::numeric / ({TABLE}.samples + EXCLUDED.samples))' for stat in STATS)
+    return f"""
+        WITH moved AS (
+            DELETE FROM {TABLE}
+            WHERE tier = {source} AND bucket < now() - interval '{age}'
+            RETURNING *
+        )
+        INSERT INTO {TABLE} ({', '.join(COLUMNS)})
+        SELECT pet_id, {target}, date_trunc('{unit}', bucket), {averages}, sum(samples)
+        FROM moved
+        GROUP BY pet_id, date_trunc('{unit}', bucket)
+        ON CONFLICT (pet_id, tier, bucket) WHERE tier > 0 DO UPDATE
+        SET {merge}, samples = {TABLE}.samples + EXCLUDED.samples
+    """
+
+
+async def rollup_stat_history(conn: asyncpg.Connection | None = None) -> None:
+    """ Прореживает историю характеристик: сутки - снимки, месяц - по часам, дальше - по дням.
+        conn - подключение asyncpg из пула бота, без него открывается отдельное подключение
+    """
+
+    try:
+        async with raw_connection(conn) as conn:
+            for rollup in ROLLUPS:
+                async with conn.transaction():
+                    status = await conn.execute(_rollup_sql(*rollup))
+                logger.debug(f'История характеристик: перенесено в уровень {rollup[1]}: {status}')
+        logger.info('Прореживание истории характеристик завершено')
+    except Exception as e:
+        logger.error(f'Ошибка в rollup_stat_history: {e}')
+
+
+@connection
+async def get_stat_history(user: _user, days: int, session: AsyncSession) -> list[PetStatHistory]:
+    """ Возвращает историю характеристик питомца пользователя за days дней одним запросом по индексу """
+
+    try:
+        pet_id = (select(UserTamagochi.id)
+                  .join(User)
+                  .where(User.user_telegram_id == user.id)
+                  .scalar_subquery())
+        result = await session.execute(select(PetStatHistory)
+                                       .where(PetStatHistory.pet_id == pet_id,
+                                              PetStatHistory.bucket >= datetime.now(timezone.utc) - timedelta(days=days))
+                                       .order_by(PetStatHistory.bucket))
+        return list(result.scalars().all())
+    except Exception as e:
+        logger.error(f'Ошибка в get_stat_history: {e}')
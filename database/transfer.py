@@ -0,0 +1,230 @@
+""" Выгрузка и загрузка пользователей и питомцев.
+    Формат - NDJSON, сжатый gzip: первая строка - заголовок, дальше одна строка на пользователя
+    с вложенным питомцем. Внутренние id не выгружаются: хозяин определяется по telegram id,
+    тип питомца - по названию, поэтому файл можно загрузить в другую бд.
+
+    python -m database.transfer export pets.ndjson.gz
+    python -m database.transfer import pets.ndjson.gz
+"""
+
+import argparse
+import asyncio
+import asyncpg
+import gzip
+import json
+import logging
+import os
+
+from datetime import datetime, timezone
+from itertools import islice
+from time import monotonic
+from typing import Iterator
+
+from database.methods import db_user, db_password, db_host, db_name
+from utilites.logger import get_logger
+
+logger = get_logger('transfer', file_level=logging.DEBUG, console_level=logging.INFO)
+
+FORMAT = 'pets-v1'
+CHUNK_SIZE = 5000
+
+PET_FIELDS = ('name', 'type', 'health', 'happiness', 'grooming', 'energy', 'hunger',
+              'sick', 'sleep', 'time_sleep', 'decay_tick', 'dormant')
+
+EXPORT_SQL = """
+    SELECT owner.user_telegram_id, owner.username, owner.last_request,
+           pet.id AS pet_id, pet.name, pet_type.name AS type, pet.health, pet.happiness, pet.grooming,
+           pet.energy, pet.hunger, pet.sick, pet.sleep, pet.time_sleep, pet.decay_tick, pet.dormant
+    FROM "user" AS owner
+    LEFT JOIN user_tamagochi AS pet ON pet.owner_id = owner.id
+    LEFT JOIN type_tamagochi AS pet_type ON pet_type.id = pet.type_id
+    ORDER BY owner.id
+"""
+
+STAGING_TABLE = 'transfer_staging'
+STAGING_COLUMNS = ('telegram_id', 'username', 'last_request', 'has_pet', *PET_FIELDS)
+
+CREATE_STAGING_SQL = f"""
+    CREATE TEMPORARY TABLE IF NOT EXISTS {STAGING_TABLE} (
+        telegram_id BIGINT NOT NULL,
+        username VARCHAR(255),
+        last_request TIMESTAMPTZ,
+        has_pet BOOLEAN NOT NULL,
+        name VARCHAR(50),
+        type VARCHAR(30),
+        health INTEGER,
+        happiness INTEGER,
+        grooming INTEGER,
+        energy INTEGER,
+        hunger INTEGER,
+        sick BOOLEAN,
+        sleep BOOLEAN,
+        time_sleep TIMESTAMPTZ,
+        decay_tick BIGINT,
+        dormant BOOLEAN
+    ) ON COMMIT DELETE ROWS
+"""
+
+# Номер последней загруженной строки файла, чтобы прерванную загрузку можно было продолжить
+CREATE_CHECKPOINT_SQL = """
+    CREATE TABLE IF NOT EXISTS transfer_checkpoint (
+        source VARCHAR(255) PRIMARY KEY,
+        line BIGINT NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL
+    )
+"""
+
+# Пользователи сопоставляются по telegram id, уже существующие не меняются
+INSERT_USERS_SQL = f"""
+    INSERT INTO "user" (user_telegram_id, username, last_request)
+    SELECT DISTINCT ON (staging.telegram_id) staging.telegram_id, staging.username, staging.last_request
+    FROM {STAGING_TABLE} AS staging
+    WHERE NOT EXISTS (SELECT 1 FROM "user" WHERE "user".user_telegram_id = staging.telegram_id)
+"""
+
+# owner_id и type_id берутся из бд назначения, у хозяина может быть только один питомец
+INSERT_PETS_SQL = f"""
+    INSERT INTO user_tamagochi (owner_id, name, type_id, health, happiness, grooming, energy, hunger,
+                                sick, sleep, time_sleep, decay_tick, dormant)
+    SELECT owner.id, staging.name, pet_type.id, staging.health, staging.happiness, staging.grooming,
+           staging.energy, staging.hunger, staging.sick, staging.sleep, staging.time_sleep,
+           staging.decay_tick, COALESCE(staging.dormant, false)
+    FROM {STAGING_TABLE} AS staging
+    JOIN "user" AS owner ON owner.user_telegram_id = staging.telegram_id
+    JOIN type_tamagochi AS pet_type ON pet_type.name = staging.type
+    WHERE staging.has_pet
+    ON CONFLICT (owner_id) DO NOTHING
+"""
+
+
+async def _connect() -> asyncpg.Connection:
+    return await asyncpg.connect(f'postgresql://{db_user}:{db_password}@{db_host}/{db_name}')
+
+
+def _isoformat(value: datetime | None) -> str | None:
+    return value.isoformat() if value is not None else None
+
+
+def _parse_datetime(value: str | None) -> datetime | None:
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+async def export_pets(path: str, prefetch: int = CHUNK_SIZE) -> int:
+    """ Выгружает пользователей и питомцев в path.
+        Строки читаются курсором на стороне сервера внутри одной транзакции REPEATABLE READ,
+        поэтому выгрузка согласована и занимает постоянную память независимо от размера таблиц.
+        Возвращает количество выгруженных пользователей
+    """
+
+    started = monotonic()
+    exported = 0
+    conn = await _connect()
+    try:
+        with gzip.open(path, 'wt', encoding='utf-8') as file:
+            file.write(json.dumps({'format': FORMAT,
+                                   'exported_at': datetime.now(timezone.utc).isoformat()}) + '\n')
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                async for row in conn.cursor(EXPORT_SQL, prefetch=prefetch):
+                    pet = None
+                    if row['pet_id'] is not None:
+                        pet = {field: row[field] for field in PET_FIELDS}
+                        pet['time_sleep'] = _isoformat(pet['time_sleep'])
+                    file.write(json.dumps({'telegram_id': row['user_telegram_id'],
+                                           'username': row['username'],
+                                           'last_request': _isoformat(row['last_request']),
+                                           'pet': pet},
+                                          ensure_ascii=False) + '\n')
+                    exported += 1
+                    if exported % prefetch == 0:
+                        logger.debug(f'Выгружено пользователей: {exported}')
+    finally:
+        await conn.close()
+    logger.info(f'Выгружено пользователей: {exported} в {path} за {monotonic() - started:.1f} с')
+    return exported
+
+
+def _read_records(path: str, skip: int) -> Iterator[tuple[int, dict]]:
+    """ Читает строки файла после заголовка, пропуская первые skip, и возвращает (номер строки, запись) """
+
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        header = json.loads(file.readline())
+        if header.get('format') != FORMAT:
+            raise ValueError(f'Неизвестный формат файла {path}: {header.get("format")}')
+        for number, line in enumerate(file, start=1):
+            if number > skip and line.strip():
+                yield number, json.loads(line)
+
+
+def _staging_record(record: dict) -> tuple:
+    pet = record.get('pet')
+    pet_values = ((pet[field] for field in PET_FIELDS) if pet else (None for _ in PET_FIELDS))
+    values = dict(zip(PET_FIELDS, pet_values))
+    values['time_sleep'] = _parse_datetime(values['time_sleep'])
+    return (record['telegram_id'],
+            record.get('username'),
+            _parse_datetime(record.get('last_request')),
+            pet is not None,
+            *values.values())
+
+
+async def import_pets(path: str, source: str | None = None, chunk_size: int = CHUNK_SIZE) -> int:
+    """ Загружает пользователей и питомцев из path пачками по chunk_size строк.
+        Каждая пачка загружается через COPY во временную таблицу и переносится в user и user_tamagochi
+        в одной транзакции вместе с отметкой о прогрессе в transfer_checkpoint.
+        Повторный запуск с тем же source продолжает с первой незагруженной пачки,
+        а уже существующие пользователи и питомцы не дублируются.
+        Возвращает количество загруженных питомцев
+    """
+
+    source = source or os.path.basename(path)
+    started = monotonic()
+    imported = 0
+    conn = await _connect()
+    try:
+        await conn.execute(CREATE_CHECKPOINT_SQL)
+        await conn.execute(CREATE_STAGING_SQL)
+        done = await conn.fetchval('SELECT line FROM transfer_checkpoint WHERE source = $1', source) or 0
+        if done:
+            logger.info(f'Продолжение загрузки {source} со строки {done + 1}')
+
+        records = _read_records(path, done)
+        while chunk := list(islice(records, chunk_size)):
+            last_line = chunk[-1][0]
+            async with conn.transaction():
+                await conn.copy_records_to_table(STAGING_TABLE,
+                                                 records=[_staging_record(record) for _, record in chunk],
+                                                 columns=STAGING_COLUMNS)
+                await conn.execute(INSERT_USERS_SQL)
+                result = await conn.execute(INSERT_PETS_SQL)
+                await conn.execute("""
+                        INSERT INTO transfer_checkpoint (source, line, updated_at) VALUES ($1, $2, now())
+                        ON CONFLICT (source) DO UPDATE SET line = EXCLUDED.line, updated_at = EXCLUDED.updated_at
+                    """, source, last_line)
+            imported += int(result.split()[-1])
+            logger.debug(f'Загружено строк {source}: {last_line}, питомцев: {imported}')
+    finally:
+        await conn.close()
+    logger.info(f'Загружено питомцев: {imported} из {path} за {monotonic() - started:.1f} с')
+    return imported
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Выгрузка и загрузка пользователей и питомцев')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help='выгрузить в NDJSON.gz')
+    export_parser.add_argument('path')
+    import_parser = commands.add_parser('import', help='загрузить из NDJSON.gz')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--source', help='имя загрузки для продолжения после прерывания, '
+                                                'по умолчанию имя файла')
+    import_parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        asyncio.run(export_pets(args.path))
+    else:
+        asyncio.run(import_pets(args.path, args.source, args.chunk_size))
+
+
+if __name__ == '__main__':
+    main()
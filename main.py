@@ -1,10 +1,14 @@
 """ Основной файл запуска в докере """
 
-from bot.bot import PetBot
+from bot.bot import PetBot, TELEGRAM_BOT_TOKEN
+from bot.sharding import ShardedRunner, BOT_WORKERS
 from utilites.logger import setup_default_logging
 
 setup_default_logging()
 
 if __name__ == '__main__':
-    bot = PetBot()
-    bot.run()
+    if BOT_WORKERS > 1:
+        ShardedRunner(TELEGRAM_BOT_TOKEN, BOT_WORKERS).run()
+    else:
+        bot = PetBot()
+        bot.run()
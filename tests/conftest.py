@@ -0,0 +1,151 @@
+""" Общие фикстуры тестов.
+    Тесты с бд запускаются на отдельной тестовой базе, ее параметры задаются переменными окружения
+    test_db_host, test_db_name, test_db_user, test_db_password. Без test_db_name такие тесты пропускаются.
+    Тесты маршрутизации на реплику дополнительно требуют test_db_replica_hosts - реплику тестовой базы.
+    Тестовая база очищается и заполняется заново при каждом запуске
+"""
+
+import os
+
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import asyncpg
+import pytest
+import pytest_asyncio
+
+from telegram import User as TelegramUser
+
+TEST_DB_NAME = os.getenv('test_db_name')
+TEST_DB_REPLICA_HOSTS = os.getenv('test_db_replica_hosts', '')
+
+# Переменные окружения подменяются до импорта database.methods, где создается engine
+if TEST_DB_NAME:
+    for key in ('db_host', 'db_name', 'db_user', 'db_password'):
+        os.environ[key] = os.getenv(f'test_{key}', os.getenv(key, ''))
+    # Реплики рабочей базы в тестах не используются
+    os.environ['db_replica_hosts'] = TEST_DB_REPLICA_HOSTS
+
+from database import methods  # noqa: E402
+from database.db_init.create_and_populate_db import initialize_database  # noqa: E402
+from database.models import Base, User, UserTamagochi, TypeTamagochi  # noqa: E402
+
+requires_db = pytest.mark.skipif(not TEST_DB_NAME, reason='не задана тестовая база test_db_name')
+requires_replica = pytest.mark.skipif(not TEST_DB_NAME or not TEST_DB_REPLICA_HOSTS,
+                                      reason='не задана реплика тестовой базы test_db_replica_hosts')
+
+_ASYNCPG_METHODS = ('execute', 'executemany', 'fetch', 'fetchrow', 'fetchval', 'copy_records_to_table')
+
+
+class QueryCounter:
+    """ Считает SQL-выражения, выполненные через engine SQLAlchemy и через прямые подключения asyncpg.
+        Для asyncpg считаются и BEGIN/COMMIT транзакций, так как они тоже отдельные обращения к бд
+    """
+
+    def __init__(self):
+        self.statements: list[str] = []
+        self._raw_connections: set[int] = set()
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    def reset(self) -> None:
+        self.statements = []
+
+    def _on_execute(self, _conn, _cursor, statement, *_):
+        self.statements.append(statement)
+
+    @contextmanager
+    def watch(self, monkeypatch):
+        from sqlalchemy import event
+
+        engines = [methods.engine] + [session_maker.kw['bind'] for session_maker in methods.replica_sessions]
+        for engine in engines:
+            event.listen(engine.sync_engine, 'before_cursor_execute', self._on_execute)
+
+        # SQLAlchemy тоже работает через asyncpg, поэтому считаются только подключения из asyncpg.connect
+        original_connect = asyncpg.connect
+
+        async def connect(*args, **kwargs):
+            raw_connection = await original_connect(*args, **kwargs)
+            self._raw_connections.add(id(raw_connection))
+            return raw_connection
+
+        def counted(name):
+            original = getattr(asyncpg.Connection, name)
+
+            async def wrapper(conn, query, *args, **kwargs):
+                if id(conn) in self._raw_connections:
+                    self.statements.append(query)
+                return await original(conn, query, *args, **kwargs)
+            return wrapper
+
+        monkeypatch.setattr(asyncpg, 'connect', connect)
+        for name in _ASYNCPG_METHODS:
+            monkeypatch.setattr(asyncpg.Connection, name, counted(name))
+        try:
+            yield self
+        finally:
+            for engine in engines:
+                event.remove(engine.sync_engine, 'before_cursor_execute', self._on_execute)
+
+
+@pytest_asyncio.fixture(scope='session', loop_scope='session')
+async def database():
+    """ Пересоздает таблицы тестовой базы и заполняет справочники """
+
+    if not TEST_DB_NAME:
+        pytest.skip('не задана тестовая база test_db_name')
+    async with methods.engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await initialize_database()
+    # Прогрев: справочник еды и соединение пула, чтобы они не попадали в подсчет запросов
+    await methods.get_food_catalog()
+    yield methods.engine
+    await methods.engine.dispose()
+
+
+@pytest_asyncio.fixture(loop_scope='session')
+async def telegram_user(database):
+    """ Пользователь с только что созданным питомцем """
+
+    telegram_id = int.from_bytes(os.urandom(4), 'big')
+    async with methods.async_session() as session:
+        user = User(user_telegram_id=telegram_id, username='test', last_request=None)
+        session.add(user)
+        await session.flush()
+        pet_type = (await session.execute(TypeTamagochi.__table__.select().limit(1))).first()
+        session.add(UserTamagochi(owner_id=user.id, name='Тест', type_id=pet_type.id,
+                                  health=50, happiness=50, grooming=50, energy=50, hunger=50,
+                                  sick=False, sleep=False))
+        await session.commit()
+    return TelegramUser(id=telegram_id, first_name='test', is_bot=False, username='test')
+
+
+@pytest.fixture
+def query_counter(monkeypatch):
+    counter = QueryCounter()
+    with counter.watch(monkeypatch):
+        yield counter
+
+
+def make_update(user: TelegramUser, text: str = '', callback_data: str | None = None) -> MagicMock:
+    """ Апдейт с сообщением или нажатием inline-кнопки от пользователя """
+
+    update = MagicMock()
+    update.effective_user = user
+    update.message.text = text
+    update.message.reply_text = AsyncMock()
+    if callback_data is None:
+        update.callback_query = None
+    else:
+        update.callback_query.data = callback_data
+        update.callback_query.answer = AsyncMock()
+        update.callback_query.edit_message_reply_markup = AsyncMock()
+    return update
+
+
+def make_context(user_data: dict | None = None) -> SimpleNamespace:
+    return SimpleNamespace(bot=AsyncMock(), user_data={} if user_data is None else user_data, args=[])
@@ -0,0 +1,83 @@
+""" Бюджет SQL-запросов на команды бота.
+    Каждая команда выполняется как один апдейт пользователя с питомцем,
+    и число выражений к бд не должно превышать объявленный бюджет.
+    При уменьшении числа запросов бюджет нужно уменьшить вместе с изменением
+"""
+
+import pytest
+
+from bot.bot import PetBot
+from bot.state import conversation_state
+
+from .conftest import make_context, make_update, requires_db
+
+pytestmark = [requires_db, pytest.mark.asyncio(loop_scope='session')]
+
+QUERY_BUDGET = {
+    'start': 4,
+    'check': 5,
+    'feed': 6,
+    'play': 11,
+    'grooming': 8,
+    'therapy': 8,
+    'sleep': 8,
+    'rename': 5,
+}
+
+
+def assert_budget(command: str, query_counter) -> None:
+    budget = QUERY_BUDGET[command]
+    statements = '\n'.join(query_counter.statements)
+    assert query_counter.count <= budget, (f'/{command}: {query_counter.count} запросов при бюджете {budget}\n'
+                                           f'{statements}')
+
+
+async def test_start(telegram_user, query_counter):
+    await PetBot.start(make_update(telegram_user), make_context())
+    assert_budget('start', query_counter)
+
+
+async def test_check(telegram_user, query_counter):
+    await PetBot.check_pet_stats(make_update(telegram_user), make_context())
+    assert_budget('check', query_counter)
+
+
+async def test_feed(telegram_user, query_counter):
+    update = make_update(telegram_user)
+    await PetBot.feed(update, make_context())
+    keyboard = update.message.reply_text.call_args.kwargs['reply_markup'].inline_keyboard
+    callback_data = keyboard[0][0].callback_data
+
+    await PetBot.choice_food(make_update(telegram_user, callback_data=callback_data), make_context())
+    assert_budget('feed', query_counter)
+
+
+async def test_play(telegram_user, query_counter):
+    context = make_context()
+    await PetBot.play_with_pet(make_update(telegram_user), context)
+    callback_data = f'place_{conversation_state.get(telegram_user.id, "true_place")}'
+
+    await PetBot.choice_place(make_update(telegram_user, callback_data=callback_data), context)
+    assert_budget('play', query_counter)
+
+
+async def test_grooming(telegram_user, query_counter):
+    await PetBot.grooming_pet(make_update(telegram_user), make_context())
+    assert_budget('grooming', query_counter)
+
+
+async def test_therapy(telegram_user, query_counter):
+    await PetBot.therapy(make_update(telegram_user), make_context())
+    assert_budget('therapy', query_counter)
+
+
+async def test_sleep(telegram_user, query_counter):
+    await PetBot.sleep_pet(make_update(telegram_user), make_context())
+    assert_budget('sleep', query_counter)
+
+
+async def test_rename(telegram_user, query_counter):
+    context = make_context()
+    await PetBot.rename_pet(make_update(telegram_user), context)
+    await PetBot.input_name_for_rename(make_update(telegram_user, text='Новое имя'), context)
+    assert_budget('rename', query_counter)
@@ -0,0 +1,66 @@
+""" Маршрутизация запросов между primary и репликой.
+    Проверяется, на каком engine выполнились выражения, а не результат: реплика может отставать.
+    Требует реплику тестовой базы (test_db_replica_hosts)
+"""
+
+from contextlib import contextmanager
+
+import pytest
+
+from sqlalchemy import event
+
+from database import methods
+
+from .conftest import requires_replica
+
+pytestmark = [requires_replica, pytest.mark.asyncio(loop_scope='session')]
+
+
+@contextmanager
+def routed_statements():
+    """ Считает выражения отдельно для primary и для реплик """
+
+    counts = {'primary': 0, 'replica': 0}
+    listeners = [(methods.engine.sync_engine, 'primary')]
+    listeners += [(session_maker.kw['bind'].sync_engine, 'replica') for session_maker in methods.replica_sessions]
+
+    def make_listener(target):
+        def listener(*_):
+            counts[target] += 1
+        return listener
+
+    registered = [(sync_engine, make_listener(target)) for sync_engine, target in listeners]
+    for sync_engine, listener in registered:
+        event.listen(sync_engine, 'before_cursor_execute', listener)
+    try:
+        yield counts
+    finally:
+        for sync_engine, listener in registered:
+            event.remove(sync_engine, 'before_cursor_execute', listener)
+
+
+async def test_reads_go_to_replica(telegram_user):
+    methods._recent_writes.pop(telegram_user.id, None)
+    with routed_statements() as counts:
+        await methods.get_user_tamagochi(telegram_user)
+    assert counts['primary'] == 0 and counts['replica'] > 0
+
+
+async def test_reads_stick_to_primary_after_write(telegram_user, monkeypatch):
+    await methods.rename(telegram_user, 'Новое имя')
+    with routed_statements() as counts:
+        await methods.get_user_tamagochi(telegram_user)
+    assert counts['replica'] == 0 and counts['primary'] > 0
+
+    # После окна после записи чтения снова идут на реплику
+    monkeypatch.setattr(methods, 'REPLICA_STICKY_SECONDS', 0)
+    with routed_statements() as counts:
+        await methods.get_user_tamagochi(telegram_user)
+    assert counts['primary'] == 0 and counts['replica'] > 0
+
+
+async def test_check_is_sleep_runs_on_primary(telegram_user):
+    methods._recent_writes.pop(telegram_user.id, None)
+    with routed_statements() as counts:
+        await methods.check_is_sleep(telegram_user)
+    assert counts['replica'] == 0 and counts['primary'] > 0
@@ -0,0 +1,27 @@
+""" Очередь отправки без обращения к Telegram: запросы выполняет заглушка """
+
+import asyncio
+
+import pytest
+
+from bot.send_queue import SendQueue
+
+pytestmark = pytest.mark.asyncio(loop_scope='session')
+
+
+async def _send(queue: SendQueue, chat_id: int, text: str) -> str:
+    async def callback(value):
+        return value
+
+    return await queue.process_request(callback, (text,), {}, 'sendMessage', {'chat_id': chat_id}, None)
+
+
+async def test_fractional_global_rate_still_sends():
+    # 25 сообщений в секунду на 30 процессов - меньше одного токена в секунду
+    queue = SendQueue(global_rate=25 / 30)
+    await queue.initialize()
+    try:
+        assert await asyncio.wait_for(_send(queue, 1, 'first'), timeout=1) == 'first'
+        assert await asyncio.wait_for(_send(queue, 2, 'second'), timeout=3) == 'second'
+    finally:
+        await queue.shutdown()
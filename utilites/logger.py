@@ -4,8 +4,17 @@ import logging
 import os
 
 LOG_DIR = 'logs'
-if not os.path.exists(LOG_DIR):
-    os.makedirs(LOG_DIR)
+
+
+class _LazyFileHandler(logging.FileHandler):
+    """ Файл лога и папка для него создаются при первой записи, а не при импорте модуля """
+
+    def __init__(self, filename: str):
+        super().__init__(filename, delay=True)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
 
 
 def get_logger(name: str, file_level=logging.DEBUG, console_level=logging.INFO) -> logging.Logger:
@@ -16,7 +25,7 @@ def get_logger(name: str, file_level=logging.DEBUG, console_level=logging.INFO)
 
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    file_handler = logging.FileHandler(os.path.join(LOG_DIR, f"{name}.log"))
+    file_handler = _LazyFileHandler(os.path.join(LOG_DIR, f"{name}.log"))
     file_handler.setLevel(file_level)
     file_handler.setFormatter(formatter)
 
@@ -0,0 +1,116 @@
+""" Выборочное профилирование обработчиков бота на реальном трафике """
+
+import cProfile
+import logging
+import os
+import pstats
+import random
+
+from functools import wraps
+from time import monotonic, strftime
+
+from utilites.logger import get_logger
+
+logger = get_logger('profiler', file_level=logging.DEBUG, console_level=logging.INFO)
+
+PROFILE_DIR = 'profiles'
+
+
+class _ProfiledCoroutine:
+    """ Выполняет корутину обработчика, включая профилировщик только на время ее шагов.
+        Пока обработчик ждет (бд, Telegram), event loop выполняет другие задачи,
+        и они не попадают в профиль этого обработчика
+    """
+
+    def __init__(self, coro, profile: cProfile.Profile):
+        self._coro = coro
+        self._profile = profile
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            self._profile.enable()
+            try:
+                if error is not None:
+                    yielded = self._coro.throw(error)
+                else:
+                    yielded = self._coro.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self._profile.disable()
+            try:
+                value, error = (yield yielded), None
+            except BaseException as e:
+                value, error = None, e
+
+
+class HandlerProfiler:
+    """ Профилирует случайную долю апдейтов (sample_rate от 0 до 1) через cProfile.
+        Профилируются только шаги самого обработчика, а не все задачи event loop во время его ожидания.
+        Профили агрегируются по обработчикам и раз в flush_interval секунд
+        сбрасываются на диск в PROFILE_DIR/<обработчик>-<время>.pstats,
+        для каждого обработчика хранится не больше keep_files последних файлов.
+        Файлы открываются через pstats, snakeviz или flameprof для flame graph
+    """
+
+    def __init__(self,
+                 sample_rate: float = float(os.getenv('profile_sample_rate', 0)),
+                 flush_interval: float = float(os.getenv('profile_flush_interval', 300)),
+                 keep_files: int = 48):
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.keep_files = keep_files
+        self._stats: dict[str, pstats.Stats] = {}
+        self._active = False
+        self._last_flush = monotonic()
+
+    def wrap(self, callback):
+        """ Оборачивает обработчик, профилируя sample_rate его вызовов """
+
+        name = getattr(callback, '__name__', 'handler')
+
+        @wraps(callback)
+        async def wrapper(*args, **kwargs):
+            # cProfile не поддерживает вложенные профили, поэтому одновременно профилируется один апдейт
+            if self._active or not self.sample_rate or random.random() >= self.sample_rate:
+                return await callback(*args, **kwargs)
+
+            self._active = True
+            profile = cProfile.Profile()
+            try:
+                return await _ProfiledCoroutine(callback(*args, **kwargs), profile)
+            finally:
+                self._active = False
+                self._add(name, profile)
+
+        return wrapper
+
+    def _add(self, name: str, profile: cProfile.Profile) -> None:
+        stats = self._stats.get(name)
+        if stats is None:
+            self._stats[name] = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+        if monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Сохраняет накопленные профили на диск и начинает новый период """
+
+        self._last_flush = monotonic()
+        if not self._stats:
+            return
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        timestamp = strftime('%Y%m%d-%H%M%S')
+        for name, stats in self._stats.items():
+            stats.dump_stats(os.path.join(PROFILE_DIR, f'{name}-{timestamp}.pstats'))
+            self._rotate(name)
+        logger.info(f'Сохранены профили обработчиков: {", ".join(self._stats)}')
+        self._stats = {}
+
+    def _rotate(self, name: str) -> None:
+        files = sorted(file for file in os.listdir(PROFILE_DIR)
+                       if file.startswith(f'{name}-') and file.endswith('.pstats'))
+        for file in files[:-self.keep_files]:
+            os.remove(os.path.join(PROFILE_DIR, file))
@@ -0,0 +1,30 @@
+""" Примитивы ограничения частоты запросов """
+
+from time import monotonic
+
+
+class TokenBucket:
+    """ Token bucket: rate токенов в секунду, не больше capacity накопленных """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> float:
+        """ Пытается забрать токен.
+            Возвращает 0, если токен получен, иначе сколько секунд ждать до появления токена
+        """
+
+        self._refill(monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate